@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+'''Persisted control arm calibration and robot reference configuration.
+
+Stored as a small versioned yaml file so the controller can start without
+recalibrating. Angles are in radians.'''
+import os
+import time
+import numpy as np
+import yaml
+
+default_arm_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       '..', 'calibration', 'control_arm.yaml')
+arm_config_version = 1
+#configuration arrays stored in the file, all length 6
+arm_config_fields = ['control_arm_zero', #encoder positions matching default_pos, wrapped to [0, 2pi)
+                     'default_pos']      #robot joint config the control arm zero maps to
+
+def load_arm_config(path = default_arm_config_file):
+    '''Returns a dict of the configuration arrays, or None if the file does
+    not exist. Raises ValueError for an unsupported version or bad entries'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data = yaml.safe_load(f)
+    if data.get('version') != arm_config_version:
+        raise ValueError('Unsupported arm config version {} in {}'.format(data.get('version'), path))
+    config = {}
+    for field in arm_config_fields:
+        value = np.array(data[field], dtype=float)
+        if value.shape != (6,):
+            raise ValueError('{} in {} should have 6 entries'.format(field, path))
+        config[field] = value
+    return config
+
+def save_arm_config(config, path = default_arm_config_file):
+    '''Writes the configuration arrays. The file is replaced atomically so an
+    interrupted write never leaves a truncated config behind'''
+    data = {'version': arm_config_version,
+            'saved': time.strftime('%Y-%m-%d %H:%M:%S')}
+    for field in arm_config_fields:
+        data[field] = [float(v) for v in config[field]]
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style = None)
+    os.rename(temp_path, path)
@@ -3,10 +3,19 @@ import rospy
 import numpy as np
 from copy import deepcopy
 import time
-from scipy.interpolate import InterpolatedUnivariateSpline
-
-from ur_kinematics.ur_kin_py import forward
-from kinematics import analytical_ik, nearest_ik_solution
+import threading
+
+from kinematics import forward, load_ur_kin
+from arm_config import load_arm_config, save_arm_config
+from system_id import load_joint_models
+from workspace_map import workspace_map
+from state_estimator import encoder_kalman_filter
+from sampling_profiler import sampling_profiler
+from daq_monitor import daq_stream_monitor, message_stamp
+from control_core import (controller_inputs, teleop_state, teleop_core, move_to_core,
+                          trajectory_state, trajectory_core, blended_trajectory,
+                          daq_relative_positions, collision_free_config, keepout_clearance,
+                          joint_limit_margins, joint_inversion)
 
 from std_msgs.msg import Float64MultiArray, Header
 from sensor_msgs.msg import JointState
@@ -19,22 +28,25 @@ from std_msgs.msg import Bool
 # from controller_manager_msgs.srv import SwitchController
 
 joint_vel_lim = 1.0
+#fallback if there is no saved calibration, see calibration/control_arm.yaml
 control_arm_saved_zero = np.array([0.51031649, 1.22624958, 3.31996918, 0.93126088, 3.1199832, 9.78404331])
 
 #define initial state
 
-#joint inversion - accounts for encoder axes being inverted inconsistently
-joint_inversion = np.array([-1,-1,1,-1,-1,-1]) # analog encoder dummy arm
-#joint_inversion = np.array([1,1,-1,1,1,1]) # digital encoder dummy arm
-two_pi = np.pi*2
 # # TODO Arm class
     #Breaking at shutdown
     #Follow traj
 #test_point = np.array([0.04,0.0,-0.21,1]).reshape(-1,1)
 # test_point = np.array([0.0,0.2,0.0,1]).reshape(-1,1)
-gripper_collision_points =  np.array([[0.04, 0.0, -0.21, 1.0], #fingertip
-                                      [0.05, 0.04, 0.09,  1.0],  #hydraulic outputs
-                                      [0.05, -0.04, 0.09,  1.0]]).T
+
+class ros_clock():
+    '''Live clock for the controller loops, see replay_clock in control_core.py'''
+    def now(self):
+        return time.time()
+
+    def rate(self, hz):
+        return rospy.Rate(hz)
+
 class ur5e_arm():
     '''Defines velocity based controller for ur5e arm for use in teleop project
     '''
@@ -44,11 +56,13 @@ class ur5e_arm():
     joint_reorder = [2,1,0,3,4,5]
     breaking_stop_time = 0.1 #when stoping safely, executes the stop in 0.1s Do not make large!
 
-    #throws an error and stops the arm if there is a position discontinuity in the
-    #encoder input freater than the specified threshold
-    #with the current settings of 100hz sampling, 0.1 radiands corresponds to
-    #~10 rps velocity, which is unlikely to happen unless the encoder input is wrong
-    position_jump_error = 0.1
+    #encoder samples are filtered by a kalman filter that rejects samples that
+    #are inconsistent with the current estimate. Isolated glitches are skipped,
+    #but the arm is stopped if a joint is rejected this many times in a row
+    #(at 100hz, 5 samples is 50ms of bad encoder input)
+    daq_max_consecutive_rejects = 5
+    reject_report_period = 1.0 #s, min time between rejected sample messages
+    last_reject_report = -np.inf
     # ains = np.array([10.0]*6) #works up to at least 20 on wrist 3
     joint_p_gains_varaible = np.array([5.0, 5.0, 5.0, 10.0, 10.0, 10.0]) #works up to at least 20 on wrist 3
     joint_ff_gains_varaible = np.array([0.0, 0.0, 0.0, 1.0, 1.1, 1.1])
@@ -62,6 +76,16 @@ class ur5e_arm():
     conservative_lower_lims = (np.pi/180)*np.array([45.0, -100.0, 45.0, -135.0, -135.0, 135.0])
     conservative_upper_lims = (np.pi/180)*np.array([135, -45.0, 140.0, -45.0, -45.0, 225.0])
     max_joint_speeds = np.array([3.0, 3.0, 3.0, 3.0, 3.0, 3.0])
+    max_traj_accel = 0.5 #rad/s^2, default blend acceleration for move_through
+    #soft joint lims - during teleop each joint is slowed so it can always stop
+    #at joint_limit_decel before its limit, allowing for the actuation delay.
+    #The delay is replaced by the system_id result if calibration/joint_models.yaml exists
+    soft_joint_lims = True
+    joint_limit_decel = np.array([4.0, 4.0, 4.0, 4.0, 4.0, 4.0]) #rad/s^2
+    actuation_delay = np.array([0.02, 0.02, 0.02, 0.02, 0.02, 0.02]) #s
+    #keepout (limmited to z axis height for now)
+    keepout_enabled = True
+    z_axis_lim = -0.37 # floor 0.095 #short table # #0.0 #table
     # max_joint_speeds = np.array([3.0, 3.0, 3.0, 3.0, 3.0, 3.0])*0.1
     #default control arm setpoint - should be calibrated to be 1 to 1 with default_pos
     #the robot can use relative joint control, but this saved defailt state can
@@ -75,25 +99,46 @@ class ur5e_arm():
 
     current_daq_positions = np.zeros(6)
     current_daq_velocities = np.zeros(6)
+    current_daq_accelerations = np.zeros(6)
     #DEBUG
     current_daq_rel_positions = np.zeros(6) #current_daq_positions - control_arm_ref_config
     current_daq_rel_positions_waraped = np.zeros(6)
 
-    first_daq_callback = True
 
-    def __init__(self, test_control_signal = False, conservative_joint_lims = True):
-        '''set up controller class variables & parameters'''
+    def __init__(self, test_control_signal = False, conservative_joint_lims = True, clock = None):
+        '''set up controller class variables & parameters. clock defaults to
+        ros_clock, and only needs to be replaced for testing'''
+        init_start_time = time.time()
+
+        self.clock = ros_clock() if clock is None else clock
+        self.load_arm_config()
+        self.load_actuation_delay()
+        #set by the first message of each stream, see wait_for_startup_events
+        self.joint_state_event = threading.Event()
+        self.daq_event = threading.Event()
+        self.daq_filter = encoder_kalman_filter(max_consecutive_rejects = self.daq_max_consecutive_rejects)
+        #stops teleop if the daq stream stalls or slows down, not used in test mode
+        self.daq_monitor = daq_stream_monitor(expected_rate = 100.0)
+        self.daq_input_gate = not test_control_signal
 
         if conservative_joint_lims:
             self.lower_lims = self.conservative_lower_lims
             self.upper_lims = self.conservative_upper_lims
-
-        #keepout (limmited to z axis height for now)
-        self.keepout_enabled = True
-        self.z_axis_lim = -0.37 # floor 0.095 #short table # #0.0 #table
+        #after the lims are set, the map is checked against them
+        self.load_workspace_map()
 
         #launch nodes
         rospy.init_node('teleop_controller', anonymous=True)
+        #on demand profiling, kill -USR1 <pid> or rosparam set ~profile_seconds
+        self.profiler = sampling_profiler()
+        self.profiler.install_signal_handler()
+        self.profiler_timer = self.profiler.watch_ros_param('~profile_seconds')
+        #filtered encoder estimates DEBUG, positions then velocities then accelerations
+        #made before the daq subscriber so the callback can always publish
+        self.daq_filtered_pub = rospy.Publisher("/debug_daq_filtered",
+                            Float64MultiArray,
+                            queue_size=1)
+        self.daq_filtered = Float64MultiArray(data=[0]*18)
         #start subscribers
         if test_control_signal:
             print('Running in test mode ... no daq input')
@@ -105,12 +150,6 @@ class ur5e_arm():
         rospy.Subscriber('/ur_hardware_interface/safety_mode',SafetyMode, self.safety_callback)
         #joint feedback subscriber
         rospy.Subscriber("joint_states", JointState, self.joint_state_callback)
-        #service to check if robot program is running
-        rospy.wait_for_service('/ur_hardware_interface/dashboard/program_running')
-        self.remote_control_running = rospy.ServiceProxy('ur_hardware_interface/dashboard/program_running', IsProgramRunning)
-        #service to check safety mode
-        rospy.wait_for_service('/ur_hardware_interface/dashboard/get_safety_mode')
-        self.safety_mode_proxy = rospy.ServiceProxy('/ur_hardware_interface/dashboard/get_safety_mode', GetSafetyMode)
         #start subscriber for deadman enable
         rospy.Subscriber('/enable_move',Bool,self.enable_callback)
 
@@ -126,6 +165,11 @@ class ur5e_arm():
         self.daq_pos_wraped_pub = rospy.Publisher("/debug_ref_wraped_pos",
                             Float64MultiArray,
                             queue_size=1)
+        #operator feedback, distance from each joint to its nearest limit (rad)
+        self.limit_margin_pub = rospy.Publisher("/joint_limit_margin",
+                            Float64MultiArray,
+                            queue_size=1)
+        self.limit_margin = Float64MultiArray(data=[0,0,0,0,0,0])
         self.ref_pos = Float64MultiArray(data=[0,0,0,0,0,0])
         #DEBUG
         # self.daq_pos_debug = Float64MultiArray(data=[0,0,0,0,0,0])
@@ -133,7 +177,11 @@ class ur5e_arm():
 
         #set shutdown safety behavior
         rospy.on_shutdown(self.shutdown_safe)
-        time.sleep(0.5)
+        self.wait_for_startup_events()
+        #service to check if robot program is running
+        self.remote_control_running = rospy.ServiceProxy('ur_hardware_interface/dashboard/program_running', IsProgramRunning)
+        #service to check safety mode
+        self.safety_mode_proxy = rospy.ServiceProxy('/ur_hardware_interface/dashboard/get_safety_mode', GetSafetyMode)
         self.stop_arm() #ensure arm is not moving if it was already
 
         self.velocity = Float64MultiArray(data = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
@@ -148,28 +196,123 @@ class ur5e_arm():
             self.user_prompt_ready_to_move()
         else:
             print('Ready to move')
+        print('Controller started in {:.2f} s'.format(time.time() - init_start_time))
+
+    def wait_for_startup_events(self, report_period = 5.0):
+        '''Blocks until the first joint state, the first daq message (unless in
+        test mode) and the dashboard services are available. All of them are
+        waited on in parallel, and the ur_kinematics import is done at the same
+        time so the first keepout check does not pay for it'''
+        def wait_for_service(name, event):
+            rospy.wait_for_service(name)
+            event.set()
+
+        def background(target, args = ()):
+            thread = threading.Thread(target = target, args = args)
+            thread.daemon = True
+            thread.start()
+
+        events = [('joint_states', self.joint_state_event)]
+        if self.daq_input_gate:
+            events.append(('daqdata_filtered', self.daq_event))
+        for service in ['/ur_hardware_interface/dashboard/program_running',
+                        '/ur_hardware_interface/dashboard/get_safety_mode']:
+            event = threading.Event()
+            background(wait_for_service, (service, event))
+            events.append((service, event))
+        background(load_ur_kin)
+
+        for name, event in events:
+            while not event.wait(report_period):
+                if rospy.is_shutdown():
+                    return
+                print('Waiting for {}'.format(name))
+
+    def load_arm_config(self):
+        '''Loads the saved control arm calibration and default robot config,
+        keeping the built in defaults if nothing has been saved'''
+        config = load_arm_config()
+        if config is None:
+            print('No saved control arm calibration, using defaults')
+            return
+        self.control_arm_def_config = np.mod(config['control_arm_zero'],np.pi*2)
+        self.control_arm_ref_config = deepcopy(self.control_arm_def_config)
+        self.default_pos = config['default_pos']
+        self.robot_ref_pos = deepcopy(self.default_pos)
+
+    def load_actuation_delay(self):
+        '''Uses the identified per joint delays for the soft joint lims, where available'''
+        try:
+            models = load_joint_models()
+        except (IOError, OSError):
+            return
+        except (ValueError, KeyError) as e:
+            print('Could not read the joint models ({}), using default actuation delays'.format(e))
+            return
+        identified = ~np.isnan(models['delay'])
+        self.actuation_delay = np.where(identified, models['delay'], self.actuation_delay)
+        print('Using identified actuation delays: {}'.format(self.actuation_delay))
+
+    def load_workspace_map(self):
+        '''Memory maps the precomputed workspace quality map, if one has been
+        built with workspace_map.py for lims covering the current ones. Without
+        it teleop runs at full speed everywhere'''
+        try:
+            self.workspace = workspace_map(lower_lims = self.lower_lims, upper_lims = self.upper_lims)
+        except (IOError, OSError):
+            print('No workspace map, speed is not reduced near singularities')
+            self.workspace = None
+        except ValueError as e:
+            print('Workspace map not used, speed is not reduced near singularities: {}'.format(e))
+            self.workspace = None
+
+    def save_arm_config(self):
+        save_arm_config({'control_arm_zero': self.control_arm_def_config,
+                         'default_pos': self.default_pos})
 
     def joint_state_callback(self, data):
         self.current_joint_positions[self.joint_reorder] = data.position
         self.current_joint_velocities[self.joint_reorder] = data.velocity
+        if not self.joint_state_event.is_set():
+            self.joint_state_event.set()
 
     def daq_callback(self, data):
-        previous_positions = deepcopy(self.current_daq_positions)
-        self.current_daq_positions[:] = [data.encoder1.pos, data.encoder2.pos, data.encoder3.pos, data.encoder4.pos, data.encoder5.pos, data.encoder6.pos]
-        self.current_daq_velocities[:] = [data.encoder1.vel, data.encoder2.vel, data.encoder3.vel, data.encoder4.vel, data.encoder5.vel, data.encoder6.vel]
-        self.current_daq_velocities *= joint_inversion #account for diferent conventions
-
-        if not self.first_daq_callback and np.any(np.abs(self.current_daq_positions - previous_positions) > self.position_jump_error):
+        '''Filters the encoder input. Positions are kept in the raw encoder
+        convention, velocities and accelerations have the joint inversion applied'''
+        positions = [data.encoder1.pos, data.encoder2.pos, data.encoder3.pos, data.encoder4.pos, data.encoder5.pos, data.encoder6.pos]
+        velocities = [data.encoder1.vel, data.encoder2.vel, data.encoder3.vel, data.encoder4.vel, data.encoder5.vel, data.encoder6.vel]
+        now = self.clock.now()
+        if not self.daq_event.is_set():
+            self.daq_event.set()
+        stamp = message_stamp(data)
+        self.daq_monitor.update(positions, now, stamp)
+        #timed by the sender stamp, or the nominal period if there is none,
+        #so delivery jitter is not mistaken for an encoder glitch
+        rejected = self.daq_filter.update(positions, velocities, stamp)
+
+        if self.daq_filter.fault and not self.shutdown:
             print('stopping arm - encoder error!')
-            print('Daq position change is too high')
-            print('Previous Positions:\n{}'.format(previous_positions))
-            print('New Positions:\n{}'.format(self.current_daq_positions))
+            print('Daq input rejected {} times in a row for joints {}'.format(
+                self.daq_max_consecutive_rejects, np.flatnonzero(self.daq_filter.faulted_joints)))
+            print('Estimated Positions:\n{}'.format(self.daq_filter.position))
+            print('New Positions:\n{}'.format(np.array(positions)))
             self.shutdown_safe()
-        # np.subtract(,,out=) #update relative position
-        self.current_daq_rel_positions = self.current_daq_positions - self.control_arm_ref_config
-        self.current_daq_rel_positions *= joint_inversion
-        self.current_daq_rel_positions_waraped = np.mod(self.current_daq_rel_positions+np.pi,two_pi)-np.pi
-        self.first_daq_callback = False
+        elif np.any(rejected) and now - self.last_reject_report >= self.reject_report_period:
+            #this runs at the daq rate, so only report once per period
+            print('Rejected encoder sample for joints {} ({} rejected in total)'.format(
+                np.flatnonzero(rejected), self.daq_filter.total_rejects.sum()))
+            self.last_reject_report = now
+
+        self.current_daq_positions[:] = self.daq_filter.position
+        np.multiply(self.daq_filter.velocity, joint_inversion, out = self.current_daq_velocities) #account for diferent conventions
+        np.multiply(self.daq_filter.acceleration, joint_inversion, out = self.current_daq_accelerations)
+        self.daq_filtered.data = np.concatenate((self.current_daq_positions,
+                                                 self.current_daq_velocities,
+                                                 self.current_daq_accelerations)).tolist()
+        self.daq_filtered_pub.publish(self.daq_filtered)
+        #update relative position
+        self.current_daq_rel_positions = (self.current_daq_positions - self.control_arm_ref_config)*joint_inversion
+        self.current_daq_rel_positions_waraped = daq_relative_positions(self.current_daq_positions, self.control_arm_ref_config)
 
     # def wrap_relative_angles(self):
     def safety_callback(self, data):
@@ -224,12 +367,13 @@ class ur5e_arm():
 
     def calibrate_control_arm_zero_position(self, interactive = True):
         '''Sets the control arm zero position to the current encoder joint states
-        TODO: Write configuration to storage for future use'''
+        and saves it to calibration/control_arm.yaml for future use'''
         if interactive:
             _ = raw_input("Hit enter when ready to save the control arm ref pos.")
         self.control_arm_def_config = np.mod(deepcopy(self.current_daq_positions),np.pi*2)
         self.control_arm_ref_config = deepcopy(self.control_arm_def_config)
         print("Control Arm Default Position Setpoint:\n{}\n".format(self.control_arm_def_config))
+        self.save_arm_config()
 
     def set_current_config_as_control_ref_config(self,
                                                  reset_robot_ref_config_to_current = True,
@@ -417,8 +561,6 @@ class ur5e_arm():
 
         #calculate traj from current position
         start_pos = deepcopy(self.current_joint_positions)
-        max_disp = np.max(np.abs(position-start_pos))
-        end_time = max_disp/speed
 
         #make sure this is a valid joint position
         if not self.is_joint_position(position):
@@ -434,40 +576,142 @@ class ur5e_arm():
             print("Commanded Postion Outside Joint Lims...")
             return False
 
+        core = move_to_core(self.joint_p_gains_varaible, joint_vel_lim, error_thresh = error_thresh)
+        state = core.initial_state(start_pos, position, speed, self.clock.now())
+        print('Executing Move to : \n{}\nIn {} seconds'.format(position,state.end_time-state.start_time))
+
+        rate = self.clock.rate(500) #lim loop to 500 hz
+        reached_pos = False
+        while not self.shutdown and not rospy.is_shutdown() and self.safety_mode == 1: #chutdown is set on ctrl-c.
+            if require_enable and not self.enabled:
+                print('Lost Enable, stopping')
+                break
+
+            command = core.step(state, self.get_controller_inputs(), self.clock.now())
+            if command.done:
+                print("reached target position")
+                self.stop_arm()
+                reached_pos = True
+                break
+
+            self.vel_ref.data = command.velocity
+            self.vel_pub.publish(self.vel_ref)
+            #wait
+            rate.sleep()
+
+        #make sure arm stops
+        self.stop_arm(safe = True)
+        return reached_pos
+
+    def move_through_robost(self,
+                            waypoints,
+                            speed = 0.25,
+                            accel = None,
+                            error_thresh = 0.01,
+                            override_initial_joint_lims = False,
+                            require_enable = False):
+        '''Calls the move_through method as necessary to ensure that the last
+        waypoint is reached, accounting for interruptions due to safety faults,
+        and the enable deadman if require_enable is selected. After an
+        interruption the motion resumes from the current position through the
+        waypoints that had not been passed yet. Returns False if the
+        trajectory is rejected by the limit or keepout checks'''
+        remaining = np.array(waypoints, dtype=float)
+
+        if require_enable:
+            print('Depress and hold the deadman switch when ready to move.')
+            print('Release to stop')
+
+        while not rospy.is_shutdown():
+            #check safety
+            if not self.ready_to_move():
+                self.user_prompt_ready_to_move()
+                continue
+            #check enabled
+            if not self.enabled:
+                time.sleep(0.01)
+                continue
+            #start moving
+            print('Starting Trajectory through {} waypoints'.format(len(remaining)))
+            result = self.move_through(remaining,
+                                       speed = speed,
+                                       accel = accel,
+                                       error_thresh = error_thresh,
+                                       override_initial_joint_lims = override_initial_joint_lims,
+                                       require_enable = require_enable)
+            if result is None:
+                return False
+            if result:
+                break
+            #keep the last waypoint so the goal is always reached
+            remaining = remaining[min(self.waypoints_passed, len(remaining)-1):]
+        print('Reached Goal')
+        return True
+
+    def move_through(self,
+                     waypoints,
+                     speed = 0.25,
+                     accel = None,
+                     error_thresh = 0.01,
+                     override_initial_joint_lims = False,
+                     require_enable = False):
+        '''Moves through a list of joint configurations as one continuous
+        trajectory, blending past the intermediate waypoints instead of
+        stopping at each one. The whole trajectory is checked against the
+        joint lims and keepout before moving.
+
+        Returns True if the last waypoint was reached, False if the motion was
+        interrupted and None if the trajectory was rejected. The number of
+        waypoints passed is left in self.waypoints_passed.'''
+        self.waypoints_passed = 0
+
+        #ensure safety sqitch is not enabled
+        if not self.ready_to_move():
+            self.user_prompt_ready_to_move()
+
+        #define max speed slow for safety
+        if speed > 0.5:
+            print("Limiting speed to 0.5 rad/sec")
+            speed = 0.5
+        if accel is None:
+            accel = self.max_traj_accel
 
-        print('Executing Move to : \n{}\nIn {} seconds'.format(position,end_time))
-        #list of interpolators ... this is kind of dumb, there is probably a better solution
-        traj = [InterpolatedUnivariateSpline([0.,end_time],[start_pos[i],position[i]],k=1) for i in range(6)]
+        waypoints = np.asarray(waypoints, dtype=float)
+        if waypoints.ndim != 2 or waypoints.shape[1] != 6 or len(waypoints) == 0:
+            print("Invalid Waypoints, Exiting move_through function")
+            return None
 
-        position_error = np.array([1.0]*6) #set high position error
-        pos_ref = deepcopy(start_pos)
-        rate = rospy.Rate(500) #lim loop to 500 hz
-        start_time = time.time()
+        start_pos = deepcopy(self.current_joint_positions)
+        if not override_initial_joint_lims:
+            if not self.identify_joint_lim(start_pos):
+                print("Start Position Outside Joint Lims...")
+                return None
+        trajectory = blended_trajectory(np.vstack([start_pos, waypoints]), speed, accel)
+        if not self.check_trajectory(trajectory, check_first_segment_lims = not override_initial_joint_lims):
+            return None
+
+        core = trajectory_core(self.joint_p_gains_varaible, joint_vel_lim, error_thresh = error_thresh)
+        state = trajectory_state(trajectory, self.clock.now())
+        print('Executing Move through {} waypoints in {:.2f} seconds'.format(len(waypoints), trajectory.duration))
+
+        rate = self.clock.rate(500) #lim loop to 500 hz
         reached_pos = False
         while not self.shutdown and not rospy.is_shutdown() and self.safety_mode == 1: #chutdown is set on ctrl-c.
             if require_enable and not self.enabled:
                 print('Lost Enable, stopping')
                 break
 
-            loop_time = time.time()-start_time
-            if loop_time < end_time:
-                pos_ref[:] = [traj[i](loop_time) for i in range(6)]
-            else:
-                pos_ref = position
-                # break
-                if np.all(np.abs(position_error)<error_thresh):
-                    print("reached target position")
-                    self.stop_arm()
-                    reached_pos = True
-                    break
+            now = self.clock.now()
+            self.waypoints_passed = trajectory.waypoints_passed(now - state.start_time)
+            command = core.step(state, self.get_controller_inputs(), now)
+            if command.done:
+                print("reached target position")
+                self.stop_arm()
+                reached_pos = True
+                break
 
-            position_error = pos_ref - self.current_joint_positions
-            vel_ref_temp = self.joint_p_gains_varaible*position_error
-            #enforce max velocity setting
-            np.clip(vel_ref_temp,-joint_vel_lim,joint_vel_lim,vel_ref_temp)
-            self.vel_ref.data = vel_ref_temp
+            self.vel_ref.data = command.velocity
             self.vel_pub.publish(self.vel_ref)
-            # print(pos_ref)
             #wait
             rate.sleep()
 
@@ -475,26 +719,64 @@ class ur5e_arm():
         self.stop_arm(safe = True)
         return reached_pos
 
+    def check_trajectory(self, trajectory, sample_period = 0.02, check_first_segment_lims = True):
+        '''Samples the whole trajectory and checks every sample against the
+        joint lims and, if enabled, the keepout zone in one batch. Prints the
+        first violation and returns False if there is one'''
+        times = np.append(np.arange(0.0, trajectory.duration, sample_period), trajectory.duration)
+        positions, _ = trajectory.evaluate(times)
+
+        in_lims = np.all((self.lower_lims < positions) & (positions < self.upper_lims), axis=1)
+        if not check_first_segment_lims and len(trajectory.waypoint_times) > 1:
+            #the move may start outside the lims, only check once past the first waypoint
+            in_lims |= times < trajectory.waypoint_times[1]
+        if not np.all(in_lims):
+            first = np.argmin(in_lims)
+            print('Trajectory leaves the joint lims at t = {:.2f} s'.format(times[first]))
+            self.identify_joint_lim(positions[first])
+            return False
+
+        if self.keepout_enabled:
+            clearance = keepout_clearance(positions, self.z_axis_lim)
+            if np.any(clearance < 0.0):
+                first = np.argmax(clearance < 0.0)
+                print('Trajectory enters the keepout at t = {:.2f} s, config:\n{}'.format(times[first], positions[first]))
+                return False
+        return True
+
     def return_collison_free_config(self, reference_positon):
         '''takes the proposed set of joint positions for the real robot and
         checks the forward kinematics for collisions with the floor plane and the
         defined gripper points. Returns the neares position with the same orientation
         that is not violating the floor constraint.'''
-        pose = forward(reference_positon)
-        collision_positions = np.dot(pose, gripper_collision_points)
-
-        min_point = np.argmin(collision_positions[2,:])
-        collision = collision_positions[2,min_point] < self.z_axis_lim
-        if collision:
-            # print('Z axis overrun: {}'.format(pose[2,3]))
-            #saturate pose
-            diff = pose[2,3] - collision_positions[2][min_point]
-            # print(diff)
-            pose[2,3] = self.z_axis_lim + diff
-            # pose[2,3] = self.z_axis_lim
-            #get joint ref
-            reference_positon = nearest_ik_solution(analytical_ik(pose,self.upper_lims,self.lower_lims),self.current_joint_positions,threshold=0.2)
-        return reference_positon
+        return collision_free_config(reference_positon, self.current_joint_positions,
+                                     self.z_axis_lim, self.upper_lims, self.lower_lims)
+
+    def get_controller_inputs(self):
+        '''Snapshot of the subscriber state in the form expected by the control_core step functions'''
+        return controller_inputs(self.current_joint_positions,
+                                 self.current_joint_velocities,
+                                 self.current_daq_rel_positions_waraped,
+                                 self.current_daq_velocities)
+
+    def teleop_core_kwargs(self):
+        '''Arguments of teleop_core for the current gains, lims, keepout, soft
+        lim and workspace map settings. replay_controller.py uses this too, so
+        replays run the same control law as move()'''
+        return {'p_gains': self.joint_p_gains_varaible,
+                'ff_gains': self.joint_ff_gains_varaible,
+                'max_joint_speeds': self.max_joint_speeds,
+                'lower_lims': self.lower_lims,
+                'upper_lims': self.upper_lims,
+                'keepout_enabled': self.keepout_enabled,
+                'z_axis_lim': self.z_axis_lim,
+                'max_decel': self.joint_limit_decel if self.soft_joint_lims else None,
+                'delay': self.actuation_delay,
+                'workspace_map': self.workspace}
+
+    def build_teleop_core(self):
+        '''Builds the teleop control law from the current gains, lims and keepout settings'''
+        return teleop_core(**self.teleop_core_kwargs())
 
     def move(self,
              capture_start_as_ref_pos = False,
@@ -503,59 +785,34 @@ class ur5e_arm():
         if not self.ready_to_move():
             self.user_prompt_ready_to_move()
 
-        max_pos_error = 0.5 #radians/sec
-        low_joint_vel_lim = 0.5
-
-        position_error = np.zeros(6)
-        absolute_position_error = np.zeros(6)
-        position_error_exceeded_by = np.zeros(6)
-        vel_ref_array = np.zeros(6)
-        ref_pos = deepcopy(self.current_joint_positions)
-        rate = rospy.Rate(500)
+        core = self.build_teleop_core()
+        rate = self.clock.rate(500)
+        in_poor_region = False
 
         if capture_start_as_ref_pos:
             self.set_current_config_as_control_ref_config(interactive = dialoge_enabled)
             self.current_daq_rel_positions_waraped = np.zeros(6)
         # print('safety_mode',self.safety_mode)
         while not self.shutdown and self.safety_mode == 1 and self.enabled: #chutdown is set on ctrl-c.
-            #get ref position inplace - avoids repeatedly declaring new array
-            # np.add(self.default_pos,self.current_daq_rel_positions,out = ref_pos)
-            np.add(self.robot_ref_pos,self.current_daq_rel_positions_waraped,out = ref_pos)
-            #
-
-            #enforce joint lims
-            np.clip(ref_pos, self.lower_lims, self.upper_lims, ref_pos)
-
-            #check that it is not hitting the table/floor
-            if self.keepout_enabled:
-                # #run forward kinematcs
-                # pose = forward(ref_pos)
-                # test_point_pos = np.dot(pose, test_point).reshape(-1)
-                # if test_point_pos[2] < self.z_axis_lim:
-                #     #saturate pose
-                #     diff = pose[2,3] - test_point_pos[2]
-                #     pose[2,3] = self.z_axis_lim + diff
-                #     #get joint ref
-                #     new_ref = nearest_ik_solution(analytical_ik(pose,self.upper_lims,self.lower_lims),self.current_joint_positions,threshold=0.2)
-                #     ref_pos = new_ref
-                ref_pos = self.return_collison_free_config(ref_pos)
-
-            self.ref_pos.data = ref_pos
-            self.daq_pos_pub.publish(self.ref_pos)
-
-            #inplace error calculation
-            np.subtract(ref_pos, self.current_joint_positions, position_error)
-
+            if self.daq_input_gate and not self.daq_monitor.input_ok(self.clock.now()):
+                print('Stopping - daq input is stale or too slow')
+                print(self.daq_monitor.format_summary())
+                break
+            command = core.step(teleop_state(self.robot_ref_pos), self.get_controller_inputs(), self.clock.now())
 
-            #calculate vel signal
-            np.multiply(position_error,self.joint_p_gains_varaible,out=vel_ref_array)
-            vel_ref_array += self.joint_ff_gains_varaible*self.current_daq_velocities
-            #enforce max velocity setting
-            np.clip(vel_ref_array,-self.max_joint_speeds,self.max_joint_speeds,vel_ref_array)
+            self.ref_pos.data = command.ref_pos
+            self.daq_pos_pub.publish(self.ref_pos)
+            self.limit_margin.data = joint_limit_margins(self.current_joint_positions, self.lower_lims, self.upper_lims)
+            self.limit_margin_pub.publish(self.limit_margin)
+            #warn once on entering/leaving a poor region, the core does the slow down
+            if self.workspace is not None:
+                poor = self.workspace.quality(command.ref_pos, self.z_axis_lim) < 1.0
+                if poor != in_poor_region:
+                    in_poor_region = poor
+                    print('Near a singularity or the keepout - reducing speed' if poor else 'Leaving reduced speed region')
 
             #publish
-            self.vel_ref.data = vel_ref_array
-            # self.ref_vel_pub.publish(self.vel_ref)
+            self.vel_ref.data = command.velocity
             self.vel_pub.publish(self.vel_ref)
             #wait
             rate.sleep()
@@ -577,6 +834,10 @@ class ur5e_arm():
             if not self.enabled:
                 time.sleep(0.01)
                 continue
+            #check daq input
+            if self.daq_input_gate and not self.daq_monitor.input_ok(self.clock.now()):
+                time.sleep(0.01)
+                continue
             #start moving
             print('Starting Free Movement')
             self.move(capture_start_as_ref_pos = True,
@@ -589,7 +850,6 @@ if __name__ == "__main__":
     print("starting")
 
     arm = ur5e_arm(test_control_signal=False, conservative_joint_lims = False)
-    time.sleep(1)
     arm.stop_arm()
 
 
@@ -0,0 +1,349 @@
+#! /usr/bin/env python
+'''Pure per-tick control laws for the ur5e teleop controller.
+
+Nothing in here touches ROS, subscriber state or the wall clock. Each core
+exposes step(state, inputs, t) -> command, so the same code can be driven by
+the live loops in arm_controller.py or pushed through recorded logs faster
+than real time by replay_controller.py'''
+from collections import namedtuple
+import numpy as np
+
+from kinematics import forward, analytical_ik, nearest_ik_solution
+
+two_pi = np.pi*2
+#joint inversion - accounts for encoder axes being inverted inconsistently
+joint_inversion = np.array([-1,-1,1,-1,-1,-1]) # analog encoder dummy arm
+#joint_inversion = np.array([1,1,-1,1,1,1]) # digital encoder dummy arm
+gripper_collision_points =  np.array([[0.04, 0.0, -0.21, 1.0], #fingertip
+                                      [0.05, 0.04, 0.09,  1.0],  #hydraulic outputs
+                                      [0.05, -0.04, 0.09,  1.0]]).T
+
+#measurements available to the controller at one tick
+controller_inputs = namedtuple('controller_inputs',
+                               ['joint_positions',   #robot joints, reordered
+                                'joint_velocities',
+                                'daq_rel_positions', #wrapped control arm offset from its ref config
+                                'daq_velocities'])   #control arm velocities, inversion applied
+#output of one tick. done is only set by cores that have a terminal condition
+controller_command = namedtuple('controller_command', ['velocity', 'ref_pos', 'done'])
+
+#state of the teleop law - the robot config that maps to the control arm ref config
+teleop_state = namedtuple('teleop_state', ['robot_ref_pos'])
+#state of a single move_to trajectory
+move_to_state = namedtuple('move_to_state', ['start_pos', 'goal_pos', 'start_time', 'end_time'])
+
+class replay_clock():
+    '''Simulated clock for faster than realtime replay. Clocks provide now()
+    in seconds and rate(hz), which returns an object with a rospy.Rate style
+    sleep(). Time only moves when a rate object sleeps or advance() is called.
+    See ros_clock in arm_controller.py for the live version'''
+    def __init__(self, start_time = 0.0):
+        self.time = start_time
+
+    def now(self):
+        return self.time
+
+    def advance(self, dt):
+        self.time += dt
+
+    def rate(self, hz):
+        return replay_rate(hz, self)
+
+class replay_rate():
+    def __init__(self, hz, clock):
+        self.period = 1.0/hz
+        self.clock = clock
+
+    def sleep(self):
+        self.clock.advance(self.period)
+
+def daq_relative_positions(daq_positions, control_arm_ref_config):
+    '''Converts raw encoder positions to the inverted, +/-pi wrapped offset
+    from the control arm reference configuration. Works on a single sample
+    or on an (n,6) array of samples'''
+    rel_positions = (daq_positions - control_arm_ref_config)*joint_inversion
+    return np.mod(rel_positions+np.pi,two_pi)-np.pi
+
+def collision_free_config(reference_positon, current_joint_positions, z_axis_lim,
+                          upper_lims, lower_lims):
+    '''takes the proposed set of joint positions for the real robot and
+    checks the forward kinematics for collisions with the floor plane and the
+    defined gripper points. Returns the neares position with the same orientation
+    that is not violating the floor constraint.'''
+    pose = forward(reference_positon)
+    collision_positions = np.dot(pose, gripper_collision_points)
+
+    min_point = np.argmin(collision_positions[2,:])
+    collision = collision_positions[2,min_point] < z_axis_lim
+    if collision:
+        #saturate pose
+        diff = pose[2,3] - collision_positions[2][min_point]
+        pose[2,3] = z_axis_lim + diff
+        #get joint ref
+        reference_positon = nearest_ik_solution(analytical_ik(pose,upper_lims,lower_lims),current_joint_positions,threshold=0.2)
+    return reference_positon
+
+def joint_limit_margins(positions, lower_lims, upper_lims):
+    '''Distance from each joint to its nearest limit, negative outside the lims'''
+    return np.minimum(upper_lims - positions, positions - lower_lims)
+
+def soft_limit_velocity(velocity, positions, joint_velocities, lower_lims, upper_lims,
+                        max_decel, delay = 0.0):
+    '''Limits the commanded velocity of each joint toward its limits to the
+    speed it can still brake from at max_decel, v = sqrt(2*a*d), so joints
+    slow down smoothly as they approach a limit instead of arriving at full
+    speed. The distance covered at the current speed during the actuation
+    delay is not counted as braking distance. Motion away from a limit is
+    never restricted'''
+    dist_upper = upper_lims - positions - np.maximum(joint_velocities, 0.0)*delay
+    dist_lower = positions - lower_lims - np.maximum(-joint_velocities, 0.0)*delay
+    max_up = np.sqrt(2*max_decel*np.maximum(dist_upper, 0.0))
+    max_down = np.sqrt(2*max_decel*np.maximum(dist_lower, 0.0))
+    return np.clip(velocity, -max_down, max_up)
+
+class teleop_core():
+    '''Control law used by ur5e_arm.move(). The reference is the robot ref
+    config offset by the control arm motion, clipped to the joint lims and
+    pushed out of the keepout zone. Velocity is P on position error plus
+    feedforward of the control arm velocity. If max_decel is set, the
+    velocity is also limited by the soft joint limit braking envelope, and if
+    a workspace_map is given the max speeds are scaled down near
+    singularities and the keepout.'''
+    def __init__(self, p_gains, ff_gains, max_joint_speeds, lower_lims, upper_lims,
+                 keepout_enabled = True, z_axis_lim = -0.37, max_decel = None, delay = 0.0,
+                 workspace_map = None):
+        self.p_gains = p_gains
+        self.ff_gains = ff_gains
+        self.max_joint_speeds = max_joint_speeds
+        self.lower_lims = lower_lims
+        self.upper_lims = upper_lims
+        self.keepout_enabled = keepout_enabled
+        self.z_axis_lim = z_axis_lim
+        self.max_decel = max_decel
+        self.delay = delay
+        self.workspace_map = workspace_map
+
+    def step(self, state, inputs, t):
+        '''returns the controller_command for one tick. t is unused by this
+        law but kept so all cores share the same signature'''
+        ref_pos = state.robot_ref_pos + inputs.daq_rel_positions
+        #enforce joint lims
+        np.clip(ref_pos, self.lower_lims, self.upper_lims, ref_pos)
+        #check that it is not hitting the table/floor
+        if self.keepout_enabled:
+            ref_pos = collision_free_config(ref_pos, inputs.joint_positions, self.z_axis_lim,
+                                            self.upper_lims, self.lower_lims)
+
+        velocity = self.p_gains*(ref_pos - inputs.joint_positions)
+        velocity += self.ff_gains*inputs.daq_velocities
+        #enforce max velocity setting, reduced in poor regions of the workspace
+        max_speeds = self.max_joint_speeds
+        if self.workspace_map is not None:
+            max_speeds = max_speeds*self.workspace_map.speed_scale(ref_pos, self.z_axis_lim)
+        np.clip(velocity,-max_speeds,max_speeds,velocity)
+        #slow down approaching the joint lims
+        if self.max_decel is not None:
+            velocity = soft_limit_velocity(velocity, inputs.joint_positions, inputs.joint_velocities,
+                                           self.lower_lims, self.upper_lims, self.max_decel, self.delay)
+        return controller_command(velocity, ref_pos, False)
+
+class move_to_core():
+    '''Control law used by ur5e_arm.move_to(). Tracks a constant speed linear
+    interpolation from start_pos to goal_pos and reports done once the goal
+    time has passed and every joint is within error_thresh.'''
+    def __init__(self, p_gains, vel_lim, error_thresh = 0.01):
+        self.p_gains = p_gains
+        self.vel_lim = vel_lim
+        self.error_thresh = error_thresh
+
+    def initial_state(self, start_pos, goal_pos, speed, t):
+        '''builds the move_to_state for a move starting at time t'''
+        max_disp = np.max(np.abs(goal_pos-start_pos))
+        return move_to_state(np.array(start_pos, dtype=float), np.array(goal_pos, dtype=float),
+                             t, t + max_disp/speed)
+
+    def reference(self, state, t):
+        '''position reference at time t'''
+        duration = state.end_time - state.start_time
+        if duration <= 0.0:
+            return state.goal_pos
+        fraction = min(max((t - state.start_time)/duration, 0.0), 1.0)
+        return state.start_pos + fraction*(state.goal_pos - state.start_pos)
+
+    def step(self, state, inputs, t):
+        pos_ref = self.reference(state, t)
+        position_error = pos_ref - inputs.joint_positions
+        if t >= state.end_time and np.all(np.abs(position_error)<self.error_thresh):
+            return controller_command(np.zeros(6), pos_ref, True)
+
+        velocity = self.p_gains*position_error
+        #enforce max velocity setting
+        np.clip(velocity,-self.vel_lim,self.vel_lim,velocity)
+        return controller_command(velocity, pos_ref, False)
+
+#state of a blended waypoint trajectory started at start_time
+trajectory_state = namedtuple('trajectory_state', ['trajectory', 'start_time'])
+
+class blended_trajectory():
+    '''Joint trajectory through a list of waypoints made of linear segments
+    joined by parabolic blends (Craig, Introduction to Robotics, ch. 7). The
+    first waypoint is the start and the arm only stops at the last one; the
+    blends pass near, not through, the intermediate waypoints.
+
+    All joints share the segment durations, which start at the time the
+    slowest joint needs at max_vel and are stretched until every blend fits
+    within max_accel, so the motion is close to time optimal for the limits.
+    max_vel and max_accel may be scalars or per joint arrays.'''
+    def __init__(self, waypoints, max_vel, max_accel, max_iterations = 2000):
+        waypoints = np.array(waypoints, dtype=float).reshape(-1,6)
+        #repeated waypoints would give zero length segments
+        keep = np.ones(len(waypoints), dtype=bool)
+        keep[1:] = np.any(np.diff(waypoints, axis=0) != 0.0, axis=1)
+        self.waypoints = waypoints[keep]
+        #index of the last given waypoint each kept one stands for, so passed
+        #waypoints can be counted in the caller's list
+        self.last_given_index = np.flatnonzero(np.append(keep[1:], True))
+        self.max_vel = np.broadcast_to(np.asarray(max_vel, dtype=float), (6,))
+        self.max_accel = np.broadcast_to(np.asarray(max_accel, dtype=float), (6,))
+
+        if len(self.waypoints) == 1:
+            self.segment_durations = np.zeros(0)
+            self._build_pieces(np.zeros((1,6)), np.zeros((1,6)), np.zeros((0,6)))
+            return
+
+        deltas = np.diff(self.waypoints, axis=0)
+        durations = np.max(np.abs(deltas)/self.max_vel, axis=1)
+        for _ in range(max_iterations):
+            blend_times, blend_accels, linear_times, infeasible = self._blends(deltas, durations)
+            if not np.any(infeasible):
+                break
+            durations[infeasible] *= 1.01
+        else:
+            raise ValueError('Could not fit a trajectory within the velocity and acceleration limits')
+        self.segment_durations = durations
+        self._build_pieces(blend_times, blend_accels, linear_times)
+
+    def _blends(self, deltas, durations):
+        '''Blend times and accelerations at each waypoint and linear segment
+        times for the given segment durations, per joint. Also returns the
+        segments that do not fit the limits and need more time'''
+        td = durations[:,None]
+        a_max = self.max_accel
+        n_seg = len(deltas)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if n_seg == 1:
+                #single segment, symmetric accelerate/cruise/decelerate
+                tb = (td[0] - np.sqrt(td[0]**2 - 4*np.abs(deltas[0])/a_max))/2
+                velocities = deltas/(td - tb)
+                accel = np.sign(deltas[0])*a_max
+                blend_times = np.vstack([tb, tb])
+                blend_accels = np.vstack([accel, -accel])
+            else:
+                velocities = deltas/td
+                blend_times = np.zeros((n_seg+1,6))
+                blend_accels = np.zeros((n_seg+1,6))
+                #first and last blends start and end at rest
+                blend_accels[0] = np.sign(deltas[0])*a_max
+                blend_times[0] = td[0] - np.sqrt(td[0]**2 - 2*np.abs(deltas[0])/a_max)
+                velocities[0] = deltas[0]/(td[0] - blend_times[0]/2)
+                blend_accels[-1] = -np.sign(deltas[-1])*a_max
+                blend_times[-1] = td[-1] - np.sqrt(td[-1]**2 - 2*np.abs(deltas[-1])/a_max)
+                velocities[-1] = deltas[-1]/(td[-1] - blend_times[-1]/2)
+                #interior blends change from one segment velocity to the next
+                dv = np.diff(velocities, axis=0)
+                blend_accels[1:-1] = np.sign(dv)*a_max
+                blend_times[1:-1] = np.abs(dv)/a_max
+            velocities = np.nan_to_num(velocities) #zero motion joints
+            #end blends take their whole length out of a segment, interior ones half
+            start_share = blend_times[:-1]/2
+            end_share = blend_times[1:]/2
+            start_share[0] = blend_times[0]
+            end_share[-1] = blend_times[-1]
+            linear_times = td - start_share - end_share
+            infeasible = np.any(np.isnan(linear_times) | (linear_times < -1e-9)
+                                | (np.abs(velocities) > self.max_vel*(1+1e-6)), axis=1)
+        return blend_times, blend_accels, np.maximum(linear_times, 0.0), infeasible
+
+    def _build_pieces(self, blend_times, blend_accels, linear_times):
+        '''Piecewise constant acceleration representation, alternating blend
+        and linear pieces, with the start time, position and velocity of
+        every piece per joint'''
+        n_pieces = 2*len(blend_times) - 1
+        piece_durations = np.zeros((n_pieces,6))
+        piece_durations[0::2] = blend_times
+        piece_durations[1::2] = linear_times
+        self.piece_accels = np.zeros((n_pieces,6))
+        self.piece_accels[0::2] = blend_accels
+        self.piece_starts = np.zeros((n_pieces,6))
+        self.piece_starts[1:] = np.cumsum(piece_durations, axis=0)[:-1]
+        self.piece_positions = np.zeros((n_pieces,6))
+        self.piece_velocities = np.zeros((n_pieces,6))
+        pos = self.waypoints[0].copy()
+        vel = np.zeros(6)
+        for i in range(n_pieces):
+            self.piece_positions[i] = pos
+            self.piece_velocities[i] = vel
+            d = piece_durations[i]
+            pos = pos + vel*d + 0.5*self.piece_accels[i]*d**2
+            vel = vel + self.piece_accels[i]*d
+        self.duration = float(np.sum(self.segment_durations))
+        #time each waypoint is passed, the centre of its blend
+        self.waypoint_times = np.concatenate([[0.0], np.cumsum(self.segment_durations)])
+
+    def evaluate(self, times):
+        '''Positions and velocities at an array of times since the start'''
+        times = np.clip(np.atleast_1d(np.asarray(times, dtype=float)), 0.0, self.duration)
+        idx = np.empty((len(times),6), dtype=int)
+        for joint in range(6):
+            idx[:,joint] = np.searchsorted(self.piece_starts[:,joint], times, side='right') - 1
+        joints = np.arange(6)
+        dt = times[:,None] - self.piece_starts[idx,joints]
+        accel = self.piece_accels[idx,joints]
+        velocities = self.piece_velocities[idx,joints] + accel*dt
+        positions = self.piece_positions[idx,joints] + self.piece_velocities[idx,joints]*dt + 0.5*accel*dt**2
+        #hold the goal exactly once finished
+        finished = times >= self.duration
+        positions[finished] = self.waypoints[-1]
+        velocities[finished] = 0.0
+        return positions, velocities
+
+    def sample(self, t):
+        '''position and velocity reference at time t since the start'''
+        positions, velocities = self.evaluate(t)
+        return positions[0], velocities[0]
+
+    def waypoints_passed(self, t):
+        '''number of waypoints after the start that have been passed by time
+        t, counted in the waypoints given to the constructor, so repeats of a
+        passed waypoint (or of the start) count as passed too'''
+        return int(self.last_given_index[np.sum(self.waypoint_times[1:] <= t)])
+
+class trajectory_core():
+    '''Control law used by ur5e_arm.move_through(). Tracks a
+    blended_trajectory with velocity feedforward plus P on position error
+    and reports done once the trajectory has finished and every joint is
+    within error_thresh.'''
+    def __init__(self, p_gains, vel_lim, error_thresh = 0.01):
+        self.p_gains = p_gains
+        self.vel_lim = vel_lim
+        self.error_thresh = error_thresh
+
+    def step(self, state, inputs, t):
+        elapsed = t - state.start_time
+        pos_ref, vel_ref = state.trajectory.sample(elapsed)
+        position_error = pos_ref - inputs.joint_positions
+        if elapsed >= state.trajectory.duration and np.all(np.abs(position_error)<self.error_thresh):
+            return controller_command(np.zeros(6), pos_ref, True)
+
+        velocity = vel_ref + self.p_gains*position_error
+        #enforce max velocity setting
+        np.clip(velocity,-self.vel_lim,self.vel_lim,velocity)
+        return controller_command(velocity, pos_ref, False)
+
+def keepout_clearance(configs, z_axis_lim):
+    '''Height of the lowest gripper collision point above the floor plane
+    for each of an (n,6) array of joint configs. Negative values are inside
+    the keepout'''
+    poses = np.array([forward(config) for config in np.reshape(configs, (-1,6))])
+    points = np.matmul(poses, gripper_collision_points) #(n,4,points)
+    return points[:,2,:].min(axis=1) - z_axis_lim
@@ -0,0 +1,158 @@
+#! /usr/bin/env python
+'''Health monitor for the daqdata_filtered encoder stream.
+
+update() is called for every message and only does O(1) bookkeeping: it
+writes into fixed size ring buffers and keeps a few running counters
+(gaps, stuck channels, smoothed rate). The heavier statistics (jitter
+percentiles, per channel noise, latency) are only computed when summary()
+is called, so the monitor can run inside the controller at full rate and
+input_ok() can be used as a per tick gate.
+
+Latency needs a sender timestamp (a header on the message). When the DAQ
+publishes from another computer the two clocks differ, so the latency is
+corrected by clock_offset (sender clock minus receiver clock, e.g. from
+chrony or ntpdate -q). If no offset is given it is estimated as the minimum
+observed delay in the window, and the reported latency is then the delay
+above the fastest message.'''
+import numpy as np
+
+class daq_stream_monitor():
+    '''expected_rate in Hz. A gap is an interval longer than gap_factor
+    expected periods, a channel is stuck after stuck_samples identical
+    positions in a row and the stream is stale when nothing has arrived for
+    stale_timeout seconds'''
+    def __init__(self,
+                 expected_rate = 100.0,
+                 window = 1000,
+                 gap_factor = 2.5,
+                 stuck_samples = 200,
+                 stale_timeout = 0.05,
+                 clock_offset = None):
+        self.expected_rate = expected_rate
+        self.window = window
+        self.gap_threshold = gap_factor/expected_rate
+        self.stuck_samples = stuck_samples
+        self.stale_timeout = stale_timeout
+        self.clock_offset = clock_offset
+        self.reset()
+
+    def reset(self):
+        self.arrival_times = np.zeros(self.window)
+        self.delays = np.full(self.window, np.nan) #arrival - sender stamp, uncorrected
+        self.positions = np.zeros((self.window,6))
+        self.index = 0
+        self.count = 0
+        self.last_arrival = None
+        self.last_positions = None
+        self.gap_count = 0
+        self.longest_gap = 0.0
+        self.repeat_counts = np.zeros(6, dtype=int)
+        self.smoothed_period = 1.0/self.expected_rate
+
+    def update(self, positions, arrival_time, stamp_time = None):
+        '''Records one message. stamp_time is the sender timestamp in seconds, if any'''
+        i = self.index
+        self.arrival_times[i] = arrival_time
+        self.positions[i] = positions
+        self.delays[i] = np.nan if stamp_time is None else arrival_time - stamp_time
+
+        if self.last_arrival is not None:
+            interval = arrival_time - self.last_arrival
+            if interval > self.gap_threshold:
+                self.gap_count += 1
+                self.longest_gap = max(self.longest_gap, interval)
+            self.smoothed_period += 0.05*(interval - self.smoothed_period)
+            same = self.positions[i] == self.last_positions
+            self.repeat_counts[same] += 1
+            self.repeat_counts[~same] = 0
+        self.last_arrival = arrival_time
+        self.last_positions = self.positions[i]
+
+        self.index = (i + 1) % self.window
+        self.count += 1
+
+    @property
+    def rate(self):
+        '''smoothed message rate in Hz'''
+        return 1.0/self.smoothed_period if self.smoothed_period > 0 else float('inf')
+
+    @property
+    def stuck_channels(self):
+        '''bool array of channels whose position has not changed for stuck_samples messages'''
+        return self.repeat_counts >= self.stuck_samples
+
+    def is_stale(self, now):
+        return self.last_arrival is None or now - self.last_arrival > self.stale_timeout
+
+    def input_ok(self, now):
+        '''Cheap per tick gate: true if the stream is fresh and running at no
+        less than half the expected rate'''
+        return not self.is_stale(now) and self.rate > 0.5*self.expected_rate
+
+    def _ordered(self, buffer):
+        '''contents of a ring buffer, oldest first'''
+        if self.count < self.window:
+            return buffer[:self.count]
+        return np.roll(buffer, -self.index, axis=0)
+
+    def summary(self):
+        '''Statistics over the current window. Intervals and latencies are in
+        seconds, noise is in the position units'''
+        n = min(self.count, self.window)
+        result = {'messages': self.count,
+                  'gaps': self.gap_count,
+                  'longest_gap': self.longest_gap,
+                  'stuck_channels': np.flatnonzero(self.stuck_channels).tolist()}
+        if n < 3:
+            return result
+
+        times = self._ordered(self.arrival_times)
+        intervals = np.diff(times)
+        p50, p95, p99 = np.percentile(intervals, [50, 95, 99])
+        result.update({'rate': (n - 1)/(times[-1] - times[0]),
+                       'interval_p50': p50,
+                       'interval_p95': p95,
+                       'interval_p99': p99,
+                       'interval_max': intervals.max(),
+                       'jitter_std': intervals.std()})
+
+        #second differences remove smooth motion, leaving the sample noise.
+        #for white noise var(d2) = 6 var(x)
+        positions = self._ordered(self.positions)
+        result['noise'] = np.diff(positions, n=2, axis=0).std(axis=0)/np.sqrt(6.0)
+
+        delays = self._ordered(self.delays)
+        delays = delays[~np.isnan(delays)]
+        if len(delays):
+            if self.clock_offset is None:
+                latencies = delays - delays.min()
+                result['latency_reference'] = 'minimum delay'
+            else:
+                latencies = delays + self.clock_offset
+                result['latency_reference'] = 'clock offset'
+            lat50, lat95 = np.percentile(latencies, [50, 95])
+            result.update({'latency_p50': lat50,
+                           'latency_p95': lat95,
+                           'latency_max': latencies.max()})
+        return result
+
+    def format_summary(self, summary = None):
+        '''Human readable multi line report'''
+        if summary is None:
+            summary = self.summary()
+        lines = ['messages {messages}, gaps {gaps} (longest {longest_gap:.4f} s), stuck channels {stuck_channels}'.format(**summary)]
+        if 'rate' in summary:
+            lines.append('rate {rate:.1f} Hz, interval p50 {interval_p50:.4f} p95 {interval_p95:.4f} '
+                         'p99 {interval_p99:.4f} max {interval_max:.4f} s, jitter std {jitter_std:.5f} s'.format(**summary))
+            lines.append('noise per channel {}'.format(np.array2string(summary['noise'], precision=5)))
+        if 'latency_p50' in summary:
+            lines.append('latency ({latency_reference}) p50 {latency_p50:.4f} p95 {latency_p95:.4f} '
+                         'max {latency_max:.4f} s'.format(**summary))
+        return '\n'.join(lines)
+
+def message_stamp(data):
+    '''Sender timestamp of a daq message in seconds, or None if it has no header'''
+    header = getattr(data, 'header', None)
+    if header is None or header.stamp.is_zero():
+        return None
+    return header.stamp.to_sec()
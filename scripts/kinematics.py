@@ -1,14 +1,8 @@
 #! /usr/bin/env python
-import rospy
 import numpy as np
 import time
 from copy import deepcopy
 
-from ur_kinematics.ur_kin_py import forward, inverse
-
-from sensor_msgs.msg import JointState
-from std_msgs.msg import Float64MultiArray, Header
-
 
 joint_inversion = np.array([-1,-1,1,-1,-1,-1])
 joint_reorder = [2,1,0,3,4,5]
@@ -17,6 +11,26 @@ current_joint_velocities = np.zeros(6)
 lower_lims = (np.pi/180)*np.array([0.0, -100.0, 0.0, -180.0, -180.0, 90.0])
 upper_lims = (np.pi/180)*np.array([180.0, 0.0, 175.0, 0.0, 0.0, 270.0])
 
+#the ur_kinematics extension is only imported on the first fk/ik call, so
+#importing this module (and the controller) stays fast
+ur_kin = None
+
+def load_ur_kin():
+    '''Imports ur_kinematics on first use and returns the ur_kin_py module'''
+    global ur_kin
+    if ur_kin is None:
+        from ur_kinematics import ur_kin_py
+        ur_kin = ur_kin_py
+    return ur_kin
+
+def forward(config):
+    '''4x4 pose of the tool flange for a joint config'''
+    return load_ur_kin().forward(config)
+
+def inverse(pose, q6_des):
+    '''Raw (8,6) ik solutions for a 4x4 pose'''
+    return load_ur_kin().inverse(pose, q6_des)
+
 def analytical_ik(pose, upper_lims, lower_lims):
     '''Light wrapper around the ur_kin_py ik call, to return the full set of
     8 ik solutions, modified from the raw output to fall within the upper and
@@ -75,6 +89,9 @@ def nearest_ik_solution(solutions, current_joints, threshold = None):
     return min_error_soln.reshape(-1)
 
 def main():
+    import rospy
+    from sensor_msgs.msg import JointState
+
     rospy.init_node('test_kin', anonymous=True)
     rospy.Subscriber("joint_states", JointState, joint_state_callback)
     time.sleep(1)
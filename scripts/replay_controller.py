@@ -0,0 +1,223 @@
+#! /usr/bin/env python
+'''Replays recorded joint_states and daqdata_filtered logs through the teleop
+control law faster than real time. Used for regression checks after changing
+the controller and for what-if analysis of gains and limits.
+
+Logs can be a rosbag or a .npz produced by this script with --save-log, which
+is much faster to reload. The replay is open loop: the recorded robot joints
+are used as the measured state at every tick.
+
+usage: rosrun test_vel_controller replay_controller.py session.bag -o commands.npz'''
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from control_core import (controller_inputs, teleop_state, teleop_core,
+                          replay_clock, daq_relative_positions, joint_inversion)
+from state_estimator import encoder_kalman_filter
+from daq_monitor import message_stamp
+
+joint_reorder = [2,1,0,3,4,5]
+
+def load_bag(path, joint_topic = 'joint_states', daq_topic = 'daqdata_filtered'):
+    '''Reads the joint and daq streams out of a rosbag into arrays. Joint
+    states are reordered and daq velocities have the joint inversion applied,
+    matching the subscriber callbacks in arm_controller.py. daq_stamp is the
+    sender stamp of each daq message, nan if it has none. The arrays are
+    sized from the bag index up front, so long bags are not held as lists of
+    messages'''
+    import rosbag
+    with rosbag.Bag(path) as bag:
+        n_joint = bag.get_message_count(topic_filters = [joint_topic])
+        n_daq = bag.get_message_count(topic_filters = [daq_topic])
+        log = {'joint_t': np.zeros(n_joint),
+               'joint_pos': np.zeros((n_joint,6)),
+               'joint_vel': np.zeros((n_joint,6)),
+               'daq_t': np.zeros(n_daq),
+               'daq_stamp': np.zeros(n_daq),
+               'daq_pos': np.zeros((n_daq,6)),
+               'daq_vel': np.zeros((n_daq,6))}
+        i_joint = i_daq = 0
+        for topic, msg, t in bag.read_messages(topics = [joint_topic, daq_topic]):
+            if topic == joint_topic:
+                log['joint_t'][i_joint] = t.to_sec()
+                log['joint_pos'][i_joint,joint_reorder] = msg.position
+                log['joint_vel'][i_joint,joint_reorder] = msg.velocity
+                i_joint += 1
+            else:
+                encoders = [msg.encoder1, msg.encoder2, msg.encoder3, msg.encoder4, msg.encoder5, msg.encoder6]
+                stamp = message_stamp(msg)
+                log['daq_t'][i_daq] = t.to_sec()
+                log['daq_stamp'][i_daq] = np.nan if stamp is None else stamp
+                log['daq_pos'][i_daq] = [e.pos for e in encoders]
+                log['daq_vel'][i_daq] = [e.vel for e in encoders]
+                i_daq += 1
+    log['daq_vel'] *= joint_inversion
+    return log
+
+def load_log(path):
+    '''Loads a log from a rosbag or from a .npz saved by save_log'''
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            return dict(data)
+    return load_bag(path)
+
+def save_log(path, log):
+    np.savez(path, **log)
+
+def sample_and_hold(sample_times, tick_times):
+    '''Index of the latest sample at or before each tick, i.e. what a
+    subscriber would hold at that time. Ticks before the first sample get
+    index 0'''
+    idx = np.searchsorted(sample_times, tick_times, side = 'right') - 1
+    return np.clip(idx, 0, len(sample_times)-1)
+
+def filter_daq(log, daq_filter = None):
+    '''Runs the encoder filter over every daq sample in order, as
+    daq_callback does live, so the controller sees the same estimates. Like
+    daq_callback it is timed by the sender stamps, or the nominal period for
+    unstamped messages (and logs saved before stamps were recorded), never by
+    the bag receive times. Returns the filtered positions and velocities, the
+    velocities with the joint inversion applied like log['daq_vel']'''
+    if daq_filter is None:
+        daq_filter = encoder_kalman_filter()
+    raw_vel = log['daq_vel']*joint_inversion #undo the inversion done in load_bag
+    stamps = log.get('daq_stamp', np.full(len(log['daq_t']), np.nan))
+    positions = np.zeros((len(log['daq_t']),6))
+    velocities = np.zeros((len(log['daq_t']),6))
+    fault_reported = False
+    for k, t in enumerate(log['daq_t']):
+        daq_filter.update(log['daq_pos'][k], raw_vel[k], None if np.isnan(stamps[k]) else stamps[k])
+        positions[k] = daq_filter.position
+        velocities[k] = daq_filter.velocity*joint_inversion
+        if daq_filter.fault and not fault_reported:
+            print('Encoder fault on joints {} at t = {:.3f}, the live controller would have stopped here'.format(
+                np.flatnonzero(daq_filter.faulted_joints), t))
+            fault_reported = True
+    return positions, velocities
+
+def replay_teleop(core, log, rate = 500.0, robot_ref_pos = None, control_arm_ref_config = None,
+                  clock = None, filter_daq_input = True, chunk_ticks = 50000, allocate = None):
+    '''Steps core through the log at the given loop rate. The daq samples are
+    filtered first unless filter_daq_input is False. The ref configs
+    default to the first samples, as when move() captures the start as the
+    ref pos. Returns a dict of arrays with the tick times, commanded
+    velocities and position references.
+
+    The per tick inputs are built chunk_ticks at a time, so only the outputs
+    grow with the log length. allocate(name, shape) creates the output
+    arrays, e.g. as memory maps for hours long logs, and defaults to np.zeros'''
+    if clock is None:
+        clock = replay_clock(max(log['joint_t'][0], log['daq_t'][0]))
+    if allocate is None:
+        allocate = lambda name, shape: np.zeros(shape)
+    start_time = clock.now()
+    end_time = min(log['joint_t'][-1], log['daq_t'][-1])
+    n_ticks = max(int(np.ceil((end_time - start_time)*rate)), 0)
+
+    if filter_daq_input:
+        daq_pos, daq_vel = filter_daq(log)
+    else:
+        daq_pos, daq_vel = log['daq_pos'], log['daq_vel']
+    if robot_ref_pos is None:
+        robot_ref_pos = log['joint_pos'][sample_and_hold(log['joint_t'], [start_time])[0]]
+    if control_arm_ref_config is None:
+        control_arm_ref_config = np.mod(daq_pos[sample_and_hold(log['daq_t'], [start_time])[0]],np.pi*2)
+
+    state = teleop_state(np.array(robot_ref_pos, dtype=float))
+    result = {'t': allocate('t', (n_ticks,)),
+              'velocity': allocate('velocity', (n_ticks,6)),
+              'ref_pos': allocate('ref_pos', (n_ticks,6))}
+    loop_rate = clock.rate(rate)
+    for chunk_start in range(0, n_ticks, chunk_ticks):
+        #everything that does not depend on the controller output is done a chunk at a time
+        tick_times = start_time + np.arange(chunk_start, min(chunk_start + chunk_ticks, n_ticks))/rate
+        joint_idx = sample_and_hold(log['joint_t'], tick_times)
+        daq_idx = sample_and_hold(log['daq_t'], tick_times)
+        joint_pos = log['joint_pos'][joint_idx]
+        joint_vel = log['joint_vel'][joint_idx]
+        daq_rel_pos = daq_relative_positions(daq_pos[daq_idx], control_arm_ref_config)
+        chunk_daq_vel = daq_vel[daq_idx]
+        velocity = result['velocity'][chunk_start:chunk_start+len(tick_times)]
+        ref_pos = result['ref_pos'][chunk_start:chunk_start+len(tick_times)]
+        for i in range(len(tick_times)):
+            inputs = controller_inputs(joint_pos[i], joint_vel[i], daq_rel_pos[i], chunk_daq_vel[i])
+            command = core.step(state, inputs, clock.now())
+            velocity[i] = command.velocity
+            ref_pos[i] = command.ref_pos
+            loop_rate.sleep()
+        result['t'][chunk_start:chunk_start+len(tick_times)] = tick_times
+
+    return result
+
+def build_core(conservative_joint_lims = False, keepout_enabled = True, p_gains = None, ff_gains = None,
+               soft_joint_lims = True, use_workspace_map = True):
+    '''teleop_core with the settings of ur5e_arm, including the identified
+    actuation delays and the workspace map when they exist, optionally overridden'''
+    from arm_controller import ur5e_arm
+    #only the settings are needed, so skip __init__ and the ros node it starts
+    arm = ur5e_arm.__new__(ur5e_arm)
+    arm.load_actuation_delay()
+    if conservative_joint_lims:
+        arm.lower_lims, arm.upper_lims = arm.conservative_lower_lims, arm.conservative_upper_lims
+    if use_workspace_map:
+        arm.load_workspace_map()
+    else:
+        arm.workspace = None
+    if p_gains is not None:
+        arm.joint_p_gains_varaible = np.array(p_gains)
+    if ff_gains is not None:
+        arm.joint_ff_gains_varaible = np.array(ff_gains)
+    arm.keepout_enabled = keepout_enabled
+    arm.soft_joint_lims = soft_joint_lims
+    return teleop_core(**arm.teleop_core_kwargs())
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replay recorded teleop logs through the controller')
+    parser.add_argument('log', help = 'rosbag or .npz log')
+    parser.add_argument('-o', '--output', help = '.npz file for the replayed commands')
+    parser.add_argument('--save-log', help = 'write the parsed log to this .npz for faster reloads')
+    parser.add_argument('--rate', type = float, default = 500.0, help = 'controller loop rate (Hz)')
+    parser.add_argument('--conservative-lims', action = 'store_true')
+    parser.add_argument('--no-keepout', action = 'store_true')
+    parser.add_argument('--no-filter', action = 'store_true', help = 'use the raw daq samples instead of the filtered estimates')
+    parser.add_argument('--no-soft-lims', action = 'store_true', help = 'disable the soft joint lim braking envelope')
+    parser.add_argument('--no-workspace-map', action = 'store_true', help = 'do not slow down in poor workspace regions')
+    parser.add_argument('--p-gains', type = float, nargs = 6)
+    parser.add_argument('--ff-gains', type = float, nargs = 6)
+    args = parser.parse_args()
+
+    log = load_log(args.log)
+    if args.save_log:
+        save_log(args.save_log, log)
+    core = build_core(conservative_joint_lims = args.conservative_lims,
+                      keepout_enabled = not args.no_keepout,
+                      p_gains = args.p_gains,
+                      ff_gains = args.ff_gains,
+                      soft_joint_lims = not args.no_soft_lims,
+                      use_workspace_map = not args.no_workspace_map)
+
+    #the outputs are memory mapped so hours of log do not have to fit in memory
+    temp_dir = tempfile.mkdtemp(prefix = 'replay_')
+    def allocate(name, shape):
+        return np.lib.format.open_memmap(os.path.join(temp_dir, name + '.npy'), mode = 'w+', shape = shape)
+    try:
+        start_time = time.time()
+        result = replay_teleop(core, log, rate = args.rate, filter_daq_input = not args.no_filter,
+                               allocate = allocate)
+        elapsed = time.time() - start_time
+        ticks = len(result['t'])
+        print('Replayed {} ticks ({:.1f} s of log) in {:.2f} s, {:.0f} ticks/s'.format(
+            ticks, ticks/args.rate, elapsed, ticks/max(elapsed, 1e-9)))
+
+        if args.output:
+            np.savez(args.output, **result)
+        del result
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
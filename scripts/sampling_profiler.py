@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+'''Low overhead sampling profiler that can be switched on in a running node.
+
+A background thread periodically grabs the stack of every other thread with
+sys._current_frames() and counts identical stacks. Nothing is hooked into
+the profiled code, so the control loop timing is barely affected, unlike
+running the whole node under cProfile.
+
+Stacks are written in the folded format ("thread;outer;inner count" per
+line) read by flamegraph.pl, speedscope and inferno.
+
+Start a capture with any of
+    kill -USR1 <pid>                                  (default duration)
+    rosparam set /<node name>/profile_seconds 10
+    profiler.start(10) from a python console'''
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+class sampling_profiler():
+    '''Samples all python threads about every interval seconds for a fixed
+    duration and dumps the folded stacks to output_dir when done.
+
+    The default interval is not a multiple of the 2 ms control loop period
+    and each gap is randomly varied by +/-jitter of it, so the samples do not
+    lock onto the same phase of the loop and always land in the same code'''
+    def __init__(self, interval = 0.0037, jitter = 0.3, default_duration = 5.0, output_dir = None):
+        self.interval = interval
+        self.jitter = jitter
+        self.default_duration = default_duration
+        if output_dir is None:
+            output_dir = os.environ.get('ROS_HOME', os.path.join(os.path.expanduser('~'), '.ros'))
+        self.output_dir = output_dir
+        self.samples = Counter()
+        self.sample_count = 0
+        self.last_output = None
+        self._labels = {} #frame label per code object, formatted once
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration = None):
+        '''Starts sampling in the background for duration seconds. Returns
+        False if a capture is already running'''
+        if self.running:
+            return False
+        if duration is None:
+            duration = self.default_duration
+        self.samples = Counter()
+        self.sample_count = 0
+        self._labels = {}
+        self._stop.clear()
+        self._thread = threading.Thread(target = self._sample_loop, args = (duration,), name = 'sampling_profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        print('Profiling for {} s'.format(duration))
+        return True
+
+    def stop(self):
+        '''Ends the capture early, the results are still written'''
+        self._stop.set()
+        if self.running:
+            self._thread.join()
+
+    def _sample_loop(self, duration):
+        own_ident = threading.current_thread().ident
+        jitter = random.Random()
+        names = {}
+        end_time = time.time() + duration
+        next_time = time.time()
+        while not self._stop.is_set() and time.time() < end_time:
+            frames = sys._current_frames()
+            #threads rarely change, so only list them when a new one shows up
+            if any(ident not in names for ident in frames):
+                names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                self.samples[self._fold(names.get(ident, str(ident)), frame)] += 1
+            self.sample_count += 1
+            #schedule from the previous target so the mean rate does not drift with the sampling cost
+            next_time += self.interval*(1.0 + self.jitter*jitter.uniform(-1.0, 1.0))
+            delay = next_time - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.time()
+        self.last_output = self.dump()
+        print('Profile with {} samples written to {}'.format(self.sample_count, self.last_output))
+        self.print_summary()
+
+    def _fold(self, thread_name, frame):
+        '''root first, ; separated stack. Frames are labelled by function and
+        its definition line, not the current line, so one function is one box
+        in the flame graph'''
+        stack = []
+        labels = self._labels
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = '{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            stack.append(label)
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ';'.join(reversed(stack))
+
+    def dump(self, path = None):
+        '''Writes the folded stacks and returns the path'''
+        if path is None:
+            path = os.path.join(self.output_dir, 'profile_{}_{}.folded'.format(
+                os.getpid(), time.strftime('%Y%m%d_%H%M%S')))
+        with open(path, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('{} {}\n'.format(stack, count))
+        return path
+
+    def function_totals(self):
+        '''Inclusive sample count per (thread, function), counting each
+        function once per stack even if it recurses'''
+        totals = Counter()
+        for stack, count in self.samples.items():
+            frames = stack.split(';')
+            for frame in set(frames[1:]):
+                totals[(frames[0], frame)] += count
+        return totals
+
+    def print_summary(self, top = 15):
+        '''Prints the functions that were on the stack most often, as a
+        percentage of the time of the thread they ran in'''
+        if self.sample_count == 0:
+            return
+        print('{:>7}  {:<20} {}'.format('% time', 'thread', 'function (inclusive)'))
+        for (thread, frame), count in self.function_totals().most_common(top):
+            print('{:>7.1f}  {:<20} {}'.format(100.0*count/self.sample_count, thread, frame))
+
+    def install_signal_handler(self, signum = signal.SIGUSR1):
+        '''Starts a default length capture when the process receives signum.
+        Must be called from the main thread'''
+        signal.signal(signum, lambda signum, frame: self.start())
+
+    def watch_ros_param(self, param = '~profile_seconds', poll_period = 1.0):
+        '''Polls a ros parameter and starts a capture of that many seconds
+        whenever it is set to a positive value. The parameter is reset to 0
+        once the capture starts'''
+        import rospy
+
+        def poll(event):
+            duration = rospy.get_param(param, 0)
+            if duration > 0:
+                rospy.set_param(param, 0)
+                self.start(float(duration))
+
+        rospy.set_param(param, 0)
+        return rospy.Timer(rospy.Duration(poll_period), poll)
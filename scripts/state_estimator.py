@@ -0,0 +1,148 @@
+#! /usr/bin/env python
+'''Kalman filter for the control arm encoders.
+
+All six joints are filtered at once, each with its own independent constant
+velocity or constant acceleration model, so the per sample cost is a few
+small batched numpy operations. The encoders report both position and
+velocity, and both are used as measurements.
+
+Each joint's innovation is gated on its Mahalanobis distance. A sample that
+fails the gate is treated as a glitch and skipped for that joint (the filter
+just predicts). Only when a joint fails the gate max_consecutive_rejects
+times in a row is it reported as a persistent fault.
+
+The predict step has to use the time between the samples, not between their
+arrivals: ROS delivery jitter of a few ms is a large position error at full
+control arm speed and would be gated as a glitch. update() takes the sender
+stamp when the messages have one, otherwise the stream is assumed to be
+sampled every sample_period.'''
+import numpy as np
+
+class encoder_kalman_filter():
+    '''Six channel Kalman filter with innovation gating.
+
+    model is 'cv' (state pos, vel) or 'ca' (state pos, vel, acc).
+    process_noise is the white noise spectral density of the highest state
+    derivative (acceleration for cv, jerk for ca). pos_noise and vel_noise are
+    the measurement standard deviations. gate is the chi squared threshold on
+    the 2 dof innovation, 13.8 is 99.9%. Scalars or length 6 arrays are
+    accepted for every noise parameter. sample_period is the nominal daq
+    period used when a sample has no stamp'''
+    def __init__(self,
+                 model = 'ca',
+                 process_noise = 1e5,
+                 pos_noise = 0.002,
+                 vel_noise = 0.05,
+                 gate = 13.8,
+                 max_consecutive_rejects = 5,
+                 sample_period = 0.01,
+                 max_dt = 0.1):
+        if model not in ('cv', 'ca'):
+            raise ValueError("model must be 'cv' or 'ca', not {}".format(model))
+        self.order = 2 if model == 'cv' else 3
+        self.process_noise = np.broadcast_to(np.asarray(process_noise, dtype=float), (6,))
+        self.R = np.zeros((6,2,2))
+        self.R[:,0,0] = np.broadcast_to(pos_noise, (6,))**2
+        self.R[:,1,1] = np.broadcast_to(vel_noise, (6,))**2
+        self.gate = gate
+        self.max_consecutive_rejects = max_consecutive_rejects
+        self.sample_period = sample_period
+        self.max_dt = max_dt
+        self.reset()
+
+    def reset(self):
+        '''Forget the state, the next update reinitializes from its measurement'''
+        self.x = np.zeros((6,self.order))
+        self.P = np.zeros((6,self.order,self.order))
+        self.last_time = None
+        self.rejected = np.zeros(6, dtype=bool) #joints that failed the gate on the last update
+        self.consecutive_rejects = np.zeros(6, dtype=int)
+        self.total_rejects = np.zeros(6, dtype=int)
+
+    @property
+    def position(self):
+        return self.x[:,0]
+
+    @property
+    def velocity(self):
+        return self.x[:,1]
+
+    @property
+    def acceleration(self):
+        if self.order == 2:
+            return np.zeros(6)
+        return self.x[:,2]
+
+    @property
+    def faulted_joints(self):
+        '''bool array of joints with a persistent fault'''
+        return self.consecutive_rejects >= self.max_consecutive_rejects
+
+    @property
+    def fault(self):
+        return bool(np.any(self.faulted_joints))
+
+    def transition(self, dt):
+        '''state transition and process noise matrices for a step of dt'''
+        if self.order == 2:
+            F = np.array([[1.0, dt],
+                          [0.0, 1.0]])
+            Q = np.array([[dt**3/3, dt**2/2],
+                          [dt**2/2, dt]])
+        else:
+            F = np.array([[1.0, dt, dt**2/2],
+                          [0.0, 1.0, dt],
+                          [0.0, 0.0, 1.0]])
+            Q = np.array([[dt**5/20, dt**4/8, dt**3/6],
+                          [dt**4/8,  dt**3/3, dt**2/2],
+                          [dt**3/6,  dt**2/2, dt]])
+        return F, self.process_noise[:,None,None]*Q
+
+    def initialize(self, positions, velocities, t):
+        self.x[:] = 0.0
+        self.x[:,0] = positions
+        self.x[:,1] = velocities
+        self.P[:] = 0.0
+        self.P[:,:2,:2] = self.R
+        if self.order == 3:
+            self.P[:,2,2] = 100.0 #acceleration is unobserved at startup
+        self.last_time = t
+
+    def update(self, positions, velocities, t = None):
+        '''Runs one predict/update cycle with the measurements sampled at time
+        t (seconds, sender clock), or one sample_period after the previous
+        sample if t is None. Returns the bool array of joints whose sample
+        was rejected by the gate'''
+        positions = np.asarray(positions, dtype=float)
+        velocities = np.asarray(velocities, dtype=float)
+        if t is None:
+            t = 0.0 if self.last_time is None else self.last_time + self.sample_period
+        if self.last_time is None:
+            self.initialize(positions, velocities, t)
+            return self.rejected
+
+        #predict, clamping dt so a stalled stream does not blow up the
+        #covariance. A repeated or out of order stamp predicts by 0
+        dt = min(max(t - self.last_time, 0.0), self.max_dt)
+        F, Q = self.transition(dt)
+        self.x = np.dot(self.x, F.T)
+        self.P = np.matmul(np.matmul(F, self.P), F.T) + Q
+        self.last_time = max(t, self.last_time)
+
+        #innovation, H selects position and velocity
+        innovation = np.stack([positions, velocities], axis=1) - self.x[:,:2]
+        S = self.P[:,:2,:2] + self.R
+        S_inv = np.linalg.inv(S)
+        distance = np.einsum('ji,jik,jk->j', innovation, S_inv, innovation)
+        self.rejected = distance > self.gate
+
+        #update only the joints that pass the gate
+        accepted = ~self.rejected
+        K = np.matmul(self.P[:,:,:2], S_inv)
+        self.x[accepted] += np.einsum('jik,jk->ji', K, innovation)[accepted]
+        self.P[accepted] -= np.matmul(K, self.P[:,:2,:])[accepted]
+
+        self.consecutive_rejects[accepted] = 0
+        self.consecutive_rejects[self.rejected] += 1
+        self.total_rejects[self.rejected] += 1
+        return self.rejected
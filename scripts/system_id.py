@@ -0,0 +1,252 @@
+#! /usr/bin/env python
+'''Per-joint system identification for the ur5e velocity controller.
+
+Drives chirp, step or PRBS velocity excitations on the selected joints at a
+fixed rate, one joint at a time, records the commanded and measured joint
+velocities and fits a first order lag plus dead time model to each joint
+
+    v[k] = a*v[k-1] + b*u[k-d]
+
+giving the actuation delay (d*dt), time constant, bandwidth and steady state
+gain. The models are written to calibration/joint_models.yaml, which can be
+read back with load_joint_models().
+
+usage: rosrun test_vel_controller system_id.py --joints 3 4 5 --signal chirp'''
+import argparse
+import os
+import numpy as np
+import yaml
+
+joint_reorder = [2,1,0,3,4,5]
+joint_names = ['shoulder_pan', 'shoulder_lift', 'elbow', 'wrist_1', 'wrist_2', 'wrist_3']
+lower_lims = (np.pi/180)*np.array([0.0, -120.0, 0.0, -180.0, -180.0, 90.0])
+upper_lims = (np.pi/180)*np.array([180.0, 0.0, 175.0, 0.0, 0.0, 270.0])
+default_model_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  '..', 'calibration', 'joint_models.yaml')
+model_file_version = 1
+
+current_joint_positions = np.zeros(6)
+current_joint_velocities = np.zeros(6)
+
+def joint_state_callback(data):
+    current_joint_positions[joint_reorder] = data.position
+    current_joint_velocities[joint_reorder] = data.velocity
+
+def chirp_signal(t, amplitude, f0 = 0.1, f1 = 5.0):
+    '''Linear frequency sweep from f0 to f1 Hz over the span of t'''
+    duration = max(t[-1] - t[0], 1e-9)
+    tau = t - t[0]
+    phase = 2*np.pi*(f0*tau + 0.5*(f1-f0)/duration*tau**2)
+    return amplitude*np.sin(phase)
+
+def step_signal(t, amplitude, max_travel = 0.4):
+    '''Repeated cycles of +amplitude, rest, -amplitude, rest. Every step is
+    held long enough to settle but never travels more than max_travel, and
+    only whole cycles are run, so the joint ends up where it started'''
+    duration = t[-1] - t[0]
+    hold = min(duration/8, max_travel/abs(amplitude))
+    tau = t - t[0] - hold/2 #short rest before the first step
+    cycles = int((duration - hold/2)/(4*hold))
+    phase = np.floor(tau/hold).astype(int) % 4
+    active = (tau >= 0.0) & (tau < cycles*4*hold)
+    signal = np.zeros(len(t))
+    signal[active & (phase == 0)] = amplitude
+    signal[active & (phase == 2)] = -amplitude
+    return signal
+
+def prbs_signal(t, amplitude, bit_period = 0.05, seed = 0):
+    '''Pseudo random binary sequence switching between +/-amplitude with a
+    minimum hold of bit_period seconds'''
+    bits = np.random.RandomState(seed).randint(0, 2, int((t[-1]-t[0])/bit_period) + 1)
+    bit_idx = ((t - t[0])/bit_period).astype(int)
+    return amplitude*(2.0*bits[bit_idx] - 1.0)
+
+excitation_signals = {'chirp': chirp_signal, 'step': step_signal, 'prbs': prbs_signal}
+
+def run_excitation(joint, excitation, rate, vel_pub, max_excursion = 0.5):
+    '''Publishes the excitation on one joint at a fixed rate and records the
+    commanded and measured velocities. Stops early if the joint leaves its
+    lims or moves more than max_excursion from the start position'''
+    import rospy
+    from std_msgs.msg import Float64MultiArray
+
+    n = len(excitation)
+    commanded = np.zeros(n)
+    measured = np.zeros(n)
+    start_pos = current_joint_positions[joint]
+    command = np.zeros(6)
+    loop_rate = rospy.Rate(rate)
+    for k in range(n):
+        if rospy.is_shutdown():
+            n = k
+            break
+        position = current_joint_positions[joint]
+        if (abs(position - start_pos) > max_excursion
+                or not lower_lims[joint] < position < upper_lims[joint]):
+            print('Joint {} left the allowed range, stopping excitation'.format(joint))
+            n = k
+            break
+        command[joint] = excitation[k]
+        vel_pub.publish(Float64MultiArray(data = command))
+        commanded[k] = excitation[k]
+        measured[k] = current_joint_velocities[joint]
+        loop_rate.sleep()
+
+    vel_pub.publish(Float64MultiArray(data = [0.0]*6))
+    return commanded[:n], measured[:n]
+
+def fit_joint_model(commanded, measured, dt, max_delay = 0.1, n_time_constants = 200, max_time_constant = 2.0):
+    '''Output error fit of v[k] = a*v[k-1] + b*u[k-d]: the model is simulated
+    from the commanded velocity alone and compared to the measured one, for
+    every delay d up to max_delay and a log spaced grid of time constants at
+    once. Unlike regressing on the measured v[k-1], noise on the measured
+    velocity does not bias the delay or time constant. Returns a dict with
+    delay, time_constant, bandwidth (Hz), gain and fit_rms'''
+    u = np.asarray(commanded, dtype=float)
+    v = np.asarray(measured, dtype=float)
+    max_lag = int(round(max_delay/dt))
+    if len(v) <= max_lag + 2:
+        raise ValueError('Not enough samples to fit a model with {} s of delay'.format(max_delay))
+    if not np.any(u):
+        raise ValueError('The commanded velocity is all zeros, nothing to fit')
+
+    #unit gain first order responses to u for every candidate pole, the
+    #delays are then just shifts of these. Pole 0 is a pure delay
+    time_constants = np.concatenate([[0.0], np.logspace(np.log10(dt/4), np.log10(max_time_constant), n_time_constants)])
+    poles = np.zeros(len(time_constants))
+    poles[1:] = np.exp(-dt/time_constants[1:])
+    responses = np.empty((len(u), len(poles)))
+    x = np.zeros(len(poles))
+    for k in range(len(u)):
+        x = poles*x + (1.0 - poles)*u[k]
+        responses[k] = x
+
+    #least squares gain and residual for every (delay, pole) pair
+    target = v[max_lag:]
+    sse = np.empty((max_lag+1, len(poles)))
+    gains = np.empty((max_lag+1, len(poles)))
+    for lag in range(max_lag+1):
+        shifted = responses[max_lag-lag:len(u)-lag]
+        xx = np.einsum('ij,ij->j', shifted, shifted)
+        xy = np.dot(target, shifted)
+        gains[lag] = xy/np.maximum(xx, 1e-12)
+        sse[lag] = np.dot(target, target) - gains[lag]*xy
+
+    lag, best = np.unravel_index(np.argmin(sse), sse.shape)
+    time_constant = time_constants[best]
+    if 1 < best < len(poles) - 1:
+        #parabolic interpolation in log time constant between grid points
+        left, mid, right = sse[lag, best-1:best+2]
+        curvature = left - 2*mid + right
+        if curvature > 0:
+            step = np.log(time_constants[best+1]/time_constants[best])
+            time_constant *= np.exp(0.5*step*(left - right)/curvature)
+    if time_constant > 0.0:
+        bandwidth = 1.0/(2*np.pi*time_constant)
+    else:
+        #faster than the sample rate can resolve
+        bandwidth = 0.5/dt
+    return {'delay': float(lag*dt),
+            'time_constant': float(time_constant),
+            'bandwidth': float(bandwidth),
+            'gain': float(gains[lag, best]),
+            'fit_rms': float(np.sqrt(max(sse[lag, best], 0.0)/len(target)))}
+
+def save_joint_models(path, models, rate, signal):
+    '''Writes the fitted models, keyed by joint name'''
+    data = {'version': model_file_version,
+            'rate': float(rate),
+            'signal': signal,
+            'joints': dict((joint_names[joint], dict(model, index = joint))
+                           for joint, model in models.items())}
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style = False)
+
+def load_joint_models(path = default_model_file):
+    '''Reads a model file into per joint arrays of delay, time_constant,
+    bandwidth and gain. Joints that were not identified are nan'''
+    with open(path) as f:
+        data = yaml.safe_load(f)
+    if data.get('version') != model_file_version:
+        raise ValueError('Unsupported joint model file version {}'.format(data.get('version')))
+    fields = ['delay', 'time_constant', 'bandwidth', 'gain']
+    models = dict((field, np.full(6, np.nan)) for field in fields)
+    for model in data['joints'].values():
+        for field in fields:
+            models[field][model['index']] = model[field]
+    return models
+
+def print_models(models):
+    print('{:>14} {:>9} {:>9} {:>10} {:>7} {:>8}'.format('joint', 'delay', 'tau', 'bw (Hz)', 'gain', 'rms'))
+    for joint in sorted(models):
+        m = models[joint]
+        print('{:>14} {:>9.4f} {:>9.4f} {:>10.2f} {:>7.3f} {:>8.4f}'.format(
+            joint_names[joint], m['delay'], m['time_constant'], m['bandwidth'], m['gain'], m['fit_rms']))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Identify per joint velocity response models')
+    parser.add_argument('--joints', type = int, nargs = '+', default = [5], help = 'joint indices, 0 is the base')
+    parser.add_argument('--signal', choices = sorted(excitation_signals), default = 'chirp')
+    parser.add_argument('--amplitude', type = float, default = 0.2, help = 'excitation amplitude (rad/s)')
+    parser.add_argument('--duration', type = float, default = 10.0, help = 'excitation length per joint (s)')
+    parser.add_argument('--rate', type = float, default = 500.0, help = 'command rate (Hz)')
+    parser.add_argument('--max-excursion', type = float, default = 0.5,
+                        help = 'stop the excitation if a joint moves further than this from its start (rad)')
+    parser.add_argument('--max-delay', type = float, default = 0.1, help = 'longest delay considered in the fit (s)')
+    parser.add_argument('-o', '--output', default = default_model_file, help = 'model file to write')
+    parser.add_argument('--save-data', help = 'write the recorded signals to this .npz')
+    parser.add_argument('--fit-only', help = 'refit from a .npz written by --save-data instead of moving the arm')
+    args = parser.parse_args()
+    rate = args.rate
+
+    if args.fit_only:
+        with np.load(args.fit_only) as data:
+            #the fit is only meaningful at the rate the data was recorded at
+            rate = float(data['rate']) if 'rate' in data else args.rate
+            recordings = dict((joint, (data['commanded_{}'.format(joint)], data['measured_{}'.format(joint)]))
+                              for joint in data['joints'])
+    else:
+        import rospy
+        from std_msgs.msg import Float64MultiArray
+        from sensor_msgs.msg import JointState
+
+        rospy.init_node('system_id', anonymous=True)
+        rospy.Subscriber("joint_states", JointState, joint_state_callback)
+        vel_pub = rospy.Publisher("/joint_group_vel_controller/command",
+                                  Float64MultiArray,
+                                  queue_size=1)
+        rospy.wait_for_message("joint_states", JointState)
+
+        t = np.arange(0.0, args.duration, 1.0/rate)
+        if args.signal == 'step':
+            #leave some margin so settling overshoot does not trip the excursion check
+            excitation = step_signal(t, args.amplitude, max_travel = 0.8*args.max_excursion)
+        else:
+            excitation = excitation_signals[args.signal](t, args.amplitude)
+        if not np.any(excitation):
+            parser.error('--duration {} s is too short for a {} excitation at this amplitude'.format(
+                args.duration, args.signal))
+        recordings = {}
+        for joint in args.joints:
+            print('Exciting joint {} ({}) with a {} signal for {} s'.format(
+                joint, joint_names[joint], args.signal, args.duration))
+            recordings[joint] = run_excitation(joint, excitation, rate, vel_pub,
+                                               max_excursion = args.max_excursion)
+            rospy.sleep(1.0) #let the joint settle before the next one
+        print("Stop")
+
+        if args.save_data:
+            arrays = {'joints': np.array(sorted(recordings)), 'rate': rate}
+            for joint, (commanded, measured) in recordings.items():
+                arrays['commanded_{}'.format(joint)] = commanded
+                arrays['measured_{}'.format(joint)] = measured
+            np.savez(args.save_data, **arrays)
+
+    models = dict((int(joint), fit_joint_model(commanded, measured, 1.0/rate, max_delay = args.max_delay))
+                  for joint, (commanded, measured) in recordings.items())
+    print_models(models)
+    save_joint_models(args.output, models, rate, args.signal)
+    print('Saved models to {}'.format(args.output))
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,46 @@
 #! /usr/bin/env python
+'''Monitors the daq encoder stream: rate, jitter, gaps, per channel noise,
+stuck channels and (if the messages are stamped) latency. Run it on the
+controller computer to check the stream published from the daq computer.
 
+usage: rosrun test_vel_controller test_read_pos.py --rate 100 --period 2'''
+import argparse
 import rospy
 from ur5teleop.msg import jointdata, Joint
 
-
-def callback(data):
-    print(data.encoder1.pos)
+from daq_monitor import daq_stream_monitor, message_stamp
 
 def main():
+    parser = argparse.ArgumentParser(description = 'Report daqdata_filtered stream health')
+    parser.add_argument('--topic', default = 'daqdata_filtered')
+    parser.add_argument('--rate', type = float, default = 100.0, help = 'expected publishing rate (Hz)')
+    parser.add_argument('--window', type = int, default = 1000, help = 'messages in the statistics window')
+    parser.add_argument('--period', type = float, default = 2.0, help = 'seconds between reports')
+    parser.add_argument('--clock-offset', type = float, help = 'daq clock minus local clock (s)')
+    parser.add_argument('--print-pos', action = 'store_true', help = 'also print encoder1 position')
+    args = parser.parse_args(rospy.myargv()[1:])
+
+    monitor = daq_stream_monitor(expected_rate = args.rate,
+                                 window = args.window,
+                                 clock_offset = args.clock_offset)
+
+    def callback(data):
+        positions = [data.encoder1.pos, data.encoder2.pos, data.encoder3.pos, data.encoder4.pos, data.encoder5.pos, data.encoder6.pos]
+        monitor.update(positions, rospy.get_time(), message_stamp(data))
+        if args.print_pos:
+            print(data.encoder1.pos)
+
+    def report(event):
+        if monitor.is_stale(rospy.get_time()):
+            print('No daq messages in the last {} s'.format(monitor.stale_timeout))
+        print(monitor.format_summary())
+        print('')
 
     rospy.init_node('daq_listener', anonymous=True)
 
-    rospy.Subscriber("daqdata_filtered", jointdata, callback)
+    rospy.Subscriber(args.topic, jointdata, callback)
+    rospy.Timer(rospy.Duration(args.period), report)
 
-    # time.sleep(0.5)
     rospy.spin()
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+#! /usr/bin/env python
+'''Precomputed map of singularity and reach quality over the joint space.
+
+The map is a regular grid over the shoulder_lift, elbow, wrist_1 and wrist_2
+joints. The base and wrist_3 joints are left out: the manipulability does not
+depend on either of them, and the height of the gripper does not depend on
+the base. wrist_3 only moves the gripper points in circles around the flange
+axis, so the lowest point is taken as the exact worst case over a full turn
+of wrist_3.
+
+For every cell the map stores
+    manipulability   |det(J)| of the flange jacobian, ~0 at singularities
+    lowest_point_z   height of the lowest gripper collision point, compared
+                     against the keepout plane at runtime
+Joint limit margins are not stored, the soft joint lims already compute them
+exactly every tick.
+
+Building is done offline, in parallel, with
+    rosrun test_vel_controller workspace_map.py --resolution 5
+and each field is saved as a .npy file so the controller can memory map it
+and look a config up with a constant time index computation each tick,
+without any jacobian work.'''
+import argparse
+import os
+import time
+import numpy as np
+import yaml
+
+from kinematics import forward
+from control_core import gripper_collision_points
+
+default_map_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', 'calibration', 'workspace_map')
+map_version = 1
+mapped_joints = [1, 2, 3, 4]
+map_fields = ['manipulability', 'lowest_point_z']
+
+def flange_jacobian(config, eps = 1e-6):
+    '''Numerical 6x6 jacobian of the flange pose, linear rows first'''
+    pose = forward(config)
+    jacobian = np.empty((6,6))
+    for joint in range(6):
+        shifted = np.array(config, dtype=float)
+        shifted[joint] += eps
+        shifted_pose = forward(shifted)
+        jacobian[:3,joint] = (shifted_pose[:3,3] - pose[:3,3])/eps
+        #small rotation in the base frame
+        dR = np.dot(shifted_pose[:3,:3], pose[:3,:3].T)
+        jacobian[3:,joint] = np.array([dR[2,1]-dR[1,2], dR[0,2]-dR[2,0], dR[1,0]-dR[0,1]])/(2*eps)
+    return jacobian
+
+def evaluate_configs(configs):
+    '''Map fields for an (n,6) array of configs. Runs in the worker processes'''
+    jacobians = np.array([flange_jacobian(config) for config in configs])
+    manipulability = np.abs(np.linalg.det(jacobians))
+
+    #wrist_3 turns each point on a circle of radius r about the flange z axis,
+    #whose lowest point is r times the horizontal part of the axis below the
+    #centre of the circle
+    poses = np.array([forward(config) for config in configs])
+    radii = np.hypot(gripper_collision_points[0], gripper_collision_points[1])
+    centre_z = poses[:,2,3,None] + poses[:,2,2,None]*gripper_collision_points[2]
+    axis_horizontal = np.hypot(poses[:,0,2], poses[:,1,2])
+    lowest = (centre_z - axis_horizontal[:,None]*radii).min(axis=1)
+    return manipulability, lowest
+
+class grid_spec():
+    '''Regular grid over the mapped joints, cell centres at lower + i*step'''
+    def __init__(self, lower, step, shape):
+        self.lower = np.asarray(lower, dtype=float)
+        self.step = np.asarray(step, dtype=float)
+        self.shape = tuple(int(s) for s in shape)
+
+    @classmethod
+    def from_lims(cls, lower_lims, upper_lims, resolution):
+        lower = np.asarray(lower_lims, dtype=float)[mapped_joints]
+        upper = np.asarray(upper_lims, dtype=float)[mapped_joints]
+        shape = np.floor((upper - lower)/resolution).astype(int) + 1
+        return cls(lower, np.full(len(mapped_joints), resolution), shape)
+
+    def configs(self, flat_indices, fill = None):
+        '''full joint configs for flat cell indices. Unmapped joints get fill'''
+        configs = np.zeros((len(flat_indices),6)) if fill is None else np.tile(fill, (len(flat_indices),1))
+        idx = np.array(np.unravel_index(flat_indices, self.shape)).T
+        configs[:,mapped_joints] = self.lower + idx*self.step
+        return configs
+
+    def index(self, config):
+        '''nearest cell for a joint config, clamped to the grid'''
+        idx = np.rint((np.asarray(config)[mapped_joints] - self.lower)/self.step).astype(int)
+        return tuple(np.clip(idx, 0, np.array(self.shape) - 1))
+
+def _evaluate_chunk(args):
+    grid, start, stop = args
+    return start, evaluate_configs(grid.configs(np.arange(start, stop)))
+
+def build_workspace_map(lower_lims, upper_lims, resolution, processes = None, chunk_size = 2000):
+    '''Evaluates every grid cell across a process pool. Returns the grid_spec
+    and a dict of field arrays shaped like the grid'''
+    from multiprocessing import Pool
+
+    grid = grid_spec.from_lims(lower_lims, upper_lims, resolution)
+    n_cells = int(np.prod(grid.shape))
+    fields = dict((field, np.zeros(n_cells, dtype=np.float32)) for field in map_fields)
+    chunks = [(grid, start, min(start + chunk_size, n_cells)) for start in range(0, n_cells, chunk_size)]
+
+    pool = Pool(processes)
+    try:
+        for done, (start, (manipulability, lowest)) in enumerate(pool.imap_unordered(_evaluate_chunk, chunks)):
+            fields['manipulability'][start:start+len(manipulability)] = manipulability
+            fields['lowest_point_z'][start:start+len(lowest)] = lowest
+            if (done + 1) % max(len(chunks)//10, 1) == 0:
+                print('{}/{} chunks'.format(done + 1, len(chunks)))
+    finally:
+        pool.close()
+        pool.join()
+    return grid, dict((field, values.reshape(grid.shape)) for field, values in fields.items())
+
+def save_workspace_map(path, grid, fields, lower_lims, upper_lims):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for field in map_fields:
+        np.save(os.path.join(path, field + '.npy'), fields[field])
+    info = {'version': map_version,
+            'mapped_joints': mapped_joints,
+            'lower': grid.lower.tolist(),
+            'step': grid.step.tolist(),
+            'shape': list(grid.shape),
+            'lower_lims': np.asarray(lower_lims).tolist(),
+            'upper_lims': np.asarray(upper_lims).tolist()}
+    with open(os.path.join(path, 'grid.yaml'), 'w') as f:
+        yaml.safe_dump(info, f, default_flow_style = None)
+
+class workspace_map():
+    '''Runtime view of a saved map. The field arrays are memory mapped, so
+    loading is instant and only the pages that are looked up are read.
+
+    A config is poor when its manipulability is below min_manipulability or
+    its lowest gripper point is within min_clearance of the keepout plane.
+    speed_scale() ramps the allowed joint speed down to min_speed_scale as a
+    config gets worse, starting at twice those thresholds.
+
+    Lookups outside the grid are clamped to its edge cells, so if the joint
+    lims the controller runs with are given, a map built for narrower lims
+    (e.g. the conservative ones) raises a ValueError instead of silently
+    returning edge cells.'''
+    def __init__(self, path = default_map_dir, min_manipulability = 0.005, min_clearance = 0.05,
+                 min_speed_scale = 0.2, lower_lims = None, upper_lims = None):
+        with open(os.path.join(path, 'grid.yaml')) as f:
+            info = yaml.safe_load(f)
+        if info.get('version') != map_version:
+            raise ValueError('Unsupported workspace map version {} in {}'.format(info.get('version'), path))
+        if lower_lims is not None and upper_lims is not None:
+            uncovered = ((np.asarray(lower_lims)[mapped_joints] < np.asarray(info['lower_lims'])[mapped_joints] - 1e-9)
+                         | (np.asarray(upper_lims)[mapped_joints] > np.asarray(info['upper_lims'])[mapped_joints] + 1e-9))
+            if np.any(uncovered):
+                raise ValueError('Workspace map in {} does not cover the joint lims of joints {}, rebuild it for these lims'.format(
+                    path, np.asarray(mapped_joints)[uncovered]))
+        self.grid = grid_spec(info['lower'], info['step'], info['shape'])
+        self.fields = dict((field, np.load(os.path.join(path, field + '.npy'), mmap_mode = 'r'))
+                           for field in map_fields)
+        self.min_manipulability = min_manipulability
+        self.min_clearance = min_clearance
+        self.min_speed_scale = min_speed_scale
+
+    def lookup(self, config):
+        '''(manipulability, lowest_point_z) of the nearest cell'''
+        idx = self.grid.index(config)
+        return tuple(float(self.fields[field][idx]) for field in map_fields)
+
+    def quality(self, config, z_axis_lim):
+        '''0 at or beyond the thresholds, 1 at twice the thresholds or better'''
+        manipulability, lowest_point_z = self.lookup(config)
+        manipulability_quality = manipulability/self.min_manipulability - 1.0
+        clearance_quality = (lowest_point_z - z_axis_lim)/self.min_clearance - 1.0
+        return min(max(min(manipulability_quality, clearance_quality), 0.0), 1.0)
+
+    def speed_scale(self, config, z_axis_lim):
+        '''fraction of the max joint speeds allowed at config'''
+        return self.min_speed_scale + (1.0 - self.min_speed_scale)*self.quality(config, z_axis_lim)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Precompute the workspace quality map')
+    parser.add_argument('--resolution', type = float, default = 5.0, help = 'grid spacing (deg)')
+    parser.add_argument('--processes', type = int, help = 'worker processes, defaults to the cpu count')
+    parser.add_argument('--conservative-lims', action = 'store_true')
+    parser.add_argument('-o', '--output', default = default_map_dir, help = 'map directory')
+    args = parser.parse_args()
+
+    from arm_controller import ur5e_arm
+    if args.conservative_lims:
+        lower_lims, upper_lims = ur5e_arm.conservative_lower_lims, ur5e_arm.conservative_upper_lims
+    else:
+        lower_lims, upper_lims = ur5e_arm.lower_lims, ur5e_arm.upper_lims
+
+    start_time = time.time()
+    grid, fields = build_workspace_map(lower_lims, upper_lims, np.radians(args.resolution), args.processes)
+    save_workspace_map(args.output, grid, fields, lower_lims, upper_lims)
+    print('Mapped {} cells {} in {:.1f} s, saved to {}'.format(
+        int(np.prod(grid.shape)), grid.shape, time.time() - start_time, args.output))
+
+if __name__ == "__main__":
+    main()